@@ -1 +1,3 @@
 import datetime_forms
+
+default_app_config = 'django_more_forms.apps.MoreFormsConfig'
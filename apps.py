@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+import form_tables
+
+class MoreFormsConfig(AppConfig):
+
+    name = 'django_more_forms'
+    verbose_name = 'More forms'
+
+    def ready(self):
+        # map the tables written by warm_form_tables, if configured
+        form_tables.load_from_settings()
@@ -0,0 +1,201 @@
+import datetime
+
+from django.forms import widgets as django_widgets
+from django import forms as django_forms
+
+# A day of availability on the 5 minute grid used by
+# TimeOptionChoices.minutes(), stored as an int with bit n set when slot n
+# (n * 5 minutes after midnight) is free. Intersections, unions and free
+# slot searches across users are then single integer operations.
+
+SLOT_MINUTES = 5
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+FULL_DAY = (1 << SLOTS_PER_DAY) - 1
+HEX_WIDTH = SLOTS_PER_DAY // 4
+
+def time_to_slot(value):
+    return (value.hour * 60 + value.minute) // SLOT_MINUTES
+
+def slot_to_time(slot):
+    minutes = slot * SLOT_MINUTES
+    return datetime.time(minutes // 60, minutes % 60)
+
+def slots_to_bitmap(slots):
+    bitmap = 0
+    for slot in slots:
+        bitmap |= 1 << slot
+    return bitmap
+
+def bitmap_to_slots(bitmap):
+    slots = []
+    while bitmap:
+        low_bit = bitmap & -bitmap
+        slots.append(low_bit.bit_length() - 1)
+        bitmap ^= low_bit
+    return slots
+
+def range_to_bitmap(start_slot, end_slot):
+    # half-open [start_slot, end_slot)
+    if end_slot <= start_slot:
+        return 0
+    return ((1 << (end_slot - start_slot)) - 1) << start_slot
+
+def times_to_bitmap(ranges):
+    # ranges of (start, end) times; an end of None runs to midnight
+    bitmap = 0
+    for start, end in ranges:
+        end_slot = SLOTS_PER_DAY if end is None else time_to_slot(end)
+        bitmap |= range_to_bitmap(time_to_slot(start), end_slot)
+    return bitmap
+
+def bitmap_to_ranges(bitmap):
+    # runs of set bits as half-open (start_slot, end_slot) pairs
+    ranges = []
+    while bitmap:
+        start = (bitmap & -bitmap).bit_length() - 1
+        run = bitmap >> start
+        length = (~run & (run + 1)).bit_length() - 1
+        ranges.append((start, start + length,))
+        bitmap &= ~range_to_bitmap(start, start + length)
+    return ranges
+
+def intersect_bitmaps(bitmaps):
+    result = FULL_DAY
+    for bitmap in bitmaps:
+        result &= bitmap
+    return result
+
+def union_bitmaps(bitmaps):
+    result = 0
+    for bitmap in bitmaps:
+        result |= bitmap
+    return result
+
+def first_free_slot(bitmaps, slots=1, start_slot=0):
+    # first slot where every bitmap has `slots` consecutive free slots
+    free = intersect_bitmaps(bitmaps) & ~range_to_bitmap(0, start_slot)
+    runs = free
+    shift = 1
+    # doubling shifts: after each step bit n means n..n+shift-1 are free
+    while shift < slots:
+        step = min(shift, slots - shift)
+        runs &= runs >> step
+        shift += step
+    if not runs:
+        return None
+    return (runs & -runs).bit_length() - 1
+
+def bitmap_to_hex(bitmap):
+    return '{0:0{1}x}'.format(bitmap, HEX_WIDTH)
+
+def hex_to_bitmap(value):
+    return int(value, 16)
+
+class AvailabilityWidget(django_widgets.HiddenInput):
+
+    def __init__(self, attrs={'class': 'availability-grid'}):
+        super(AvailabilityWidget, self).__init__(attrs)
+
+    def _format_value(self, value):
+        if isinstance(value, (int, long,)):
+            return bitmap_to_hex(value)
+        return value
+
+class AvailabilityField(django_forms.Field):
+
+    widget = AvailabilityWidget
+    default_error_messages = {
+        'invalid': 'Enter a valid availability.',}
+
+    def to_python(self, value):
+        if value in django_forms.fields.EMPTY_VALUES:
+            return None
+        if isinstance(value, (int, long,)):
+            bitmap = value
+        else:
+            try:
+                bitmap = hex_to_bitmap(value.strip())
+            except (TypeError, ValueError, AttributeError):
+                raise django_forms.ValidationError(
+                    self.error_messages['invalid'])
+        if bitmap < 0 or bitmap > FULL_DAY:
+            raise django_forms.ValidationError(self.error_messages['invalid'])
+        return bitmap
+
+if __name__ == '__main__':
+    import os, sys
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'tests',
+        'django_more_forms_tests',))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_more_forms_tests.settings'
+
+    import unittest
+    from django.test import SimpleTestCase
+
+    class BitmapTest(SimpleTestCase):
+
+        def setUp(self):
+            # 9:00am-12:00pm and 1:00pm-5:00pm
+            self.alice = times_to_bitmap([
+                (datetime.time(9), datetime.time(12)),
+                (datetime.time(13), datetime.time(17)),])
+            # 10:30am-2:00pm
+            self.bob = times_to_bitmap([
+                (datetime.time(10, 30), datetime.time(14)),])
+
+        def test_slots(self):
+            self.assertEqual(SLOTS_PER_DAY, 288)
+            self.assertEqual(time_to_slot(datetime.time(23, 55)), 287)
+            self.assertEqual(slot_to_time(111), datetime.time(9, 15))
+            self.assertEqual(bitmap_to_slots(slots_to_bitmap([3, 0, 287])),
+                [0, 3, 287])
+
+        def test_ranges(self):
+            self.assertEqual(bitmap_to_ranges(self.alice),
+                [(108, 144), (156, 204)])
+            self.assertEqual(bitmap_to_ranges(FULL_DAY), [(0, 288)])
+            self.assertEqual(bitmap_to_ranges(0), [])
+
+        def test_intersection_and_union(self):
+            both = intersect_bitmaps([self.alice, self.bob])
+            self.assertEqual(bitmap_to_ranges(both),
+                [(126, 144), (156, 168)])
+            either = union_bitmaps([self.alice, self.bob])
+            self.assertEqual(bitmap_to_ranges(either), [(108, 204)])
+
+        def test_first_free_slot(self):
+            bitmaps = [self.alice, self.bob]
+            self.assertEqual(first_free_slot(bitmaps), 126)
+            self.assertEqual(first_free_slot(bitmaps, 18), 126)
+            self.assertEqual(first_free_slot(bitmaps, 19), None)
+            self.assertEqual(first_free_slot(bitmaps, 1, 130), 130)
+            self.assertEqual(first_free_slot(bitmaps, 7, 140), 156)
+
+    class AvailabilityFieldTest(SimpleTestCase):
+
+        def test_clean(self):
+            field = AvailabilityField()
+            bitmap = range_to_bitmap(0, 12)
+            self.assertEqual(field.clean(bitmap_to_hex(bitmap)), bitmap)
+            self.assertEqual(field.clean(bitmap), bitmap)
+
+        def test_clean_invalid(self):
+            field = AvailabilityField()
+            self.assertRaises(django_forms.ValidationError, field.clean,
+                'not hex')
+            self.assertRaises(django_forms.ValidationError, field.clean,
+                bitmap_to_hex(FULL_DAY + 1))
+            self.assertRaises(django_forms.ValidationError, field.clean, '')
+
+        def test_not_required(self):
+            field = AvailabilityField(required=False)
+            self.assertEqual(field.clean(''), None)
+
+        def test_render(self):
+            rendered = AvailabilityWidget().render('availability',
+                range_to_bitmap(0, 4))
+            self.assertIn('class="availability-grid"', rendered)
+            self.assertIn('value="{0}"'.format('0' * 71 + 'f'), rendered)
+
+    unittest.main()
@@ -0,0 +1,336 @@
+import re
+from urllib import unquote_plus
+
+from django.forms.formsets import TOTAL_FORM_COUNT, INITIAL_FORM_COUNT, \
+    MAX_NUM_FORM_COUNT, DELETION_FIELD_NAME, ORDERING_FIELD_NAME
+
+# Incremental parser for large urlencoded formset posts. The body is read
+# once in chunks and only the keys of the split widgets (name_0..name_n),
+# the management form and the formset's own per form fields (id, DELETE,
+# ORDER) are decoded; every other pair is skipped without touching its
+# value. Only urlencoded bodies are read this way, multipart posts are
+# parsed by django as usual.
+#
+# CsrfViewMiddleware reads request.POST for every POST it checks, so behind
+# it the body has already been parsed and that QueryDict is used instead of
+# the stream. To skip the full parse, mark the view csrf_exempt and pass
+# check_csrf=True: the token is then checked by the middleware against the
+# kept csrfmiddlewaretoken pair or the X-CSRFToken header. Reading the
+# stream replaces request.POST, so don't access request.POST or
+# request.body afterwards.
+#
+#     @csrf_exempt
+#     def schedule(request):
+#         formset = bulk_formset(ScheduleFormSet, request, 'slots',
+#             ['start'], check_csrf=True)
+
+CHUNK_SIZE = 64 * 1024
+
+MANAGEMENT_KEYS = (TOTAL_FORM_COUNT, INITIAL_FORM_COUNT, MAX_NUM_FORM_COUNT,)
+
+# kept for every form, model formsets post the primary key as id
+FORMSET_FIELDS = ('id', DELETION_FIELD_NAME, ORDERING_FIELD_NAME,)
+
+CSRF_KEY = 'csrfmiddlewaretoken'
+
+def _decode(value, encoding):
+    if '%' in value or '+' in value:
+        value = unquote_plus(value)
+    # undecodable bytes are replaced, like QueryDict does
+    return value.decode(encoding, 'replace')
+
+def iter_pairs(stream, chunk_size=CHUNK_SIZE):
+    # raw (key, value) byte strings, still url encoded
+    tail = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        pairs = (tail + chunk).split(b'&')
+        tail = pairs.pop()
+        for pair in pairs:
+            if pair:
+                key, _, value = pair.partition(b'=')
+                yield key, value
+    if tail:
+        key, _, value = tail.partition(b'=')
+        yield key, value
+
+class BulkPost(object):
+
+    def __init__(self, prefix, split_fields, extra_fields=()):
+        # split_fields are the names of split widget fields; extra_fields
+        # are single-valued fields of the forms to keep as well
+        self.prefix = prefix
+        self.split_pattern = re.compile(
+            r'^{0}-(\d+)-({1})_(\d+)$'.format(re.escape(prefix),
+                '|'.join(re.escape(name) for name in split_fields)))
+        extra_fields = tuple(extra_fields) + FORMSET_FIELDS
+        self.extra_pattern = re.compile(r'^{0}-(\d+)-({1})$'.format(
+            re.escape(prefix),
+            '|'.join(re.escape(name) for name in extra_fields)))
+        self.management_keys = frozenset(['{0}-{1}'.format(prefix, key)
+            for key in MANAGEMENT_KEYS] + [CSRF_KEY])
+        self.data = {}
+        self.groups = {}
+        self.skipped = 0
+
+    def _add(self, key, value):
+        match = self.split_pattern.match(key)
+        if match is not None:
+            value = value()
+            self.data[key] = value
+            index, name, part = match.groups()
+            values = self.groups.setdefault(int(index), {}) \
+                .setdefault(name, [])
+            part = int(part)
+            if part >= len(values):
+                values.extend([None] * (part + 1 - len(values)))
+            values[part] = value
+        elif key in self.management_keys or self.extra_pattern.match(key):
+            self.data[key] = value()
+        else:
+            self.skipped += 1
+
+    def feed(self, stream, chunk_size=CHUNK_SIZE, encoding='utf-8'):
+        # values are only decoded for the keys that are kept
+        for raw_key, raw_value in iter_pairs(stream, chunk_size):
+            self._add(_decode(raw_key, encoding),
+                lambda: _decode(raw_value, encoding))
+        return self
+
+    def feed_query_dict(self, query_dict):
+        # an already parsed request.POST, last value per key like
+        # query_dict[key]
+        for key, values in query_dict.lists():
+            self._add(key, lambda: values[-1] if values else u'')
+        return self
+
+    def iter_clean(self, fields):
+        # (index, name, value, errors) for each grouped split value, cleaned
+        # directly with fields[name] instead of going through the widgets
+        from django import forms as django_forms
+
+        for index in sorted(self.groups):
+            for name, values in sorted(self.groups[index].items()):
+                try:
+                    value = fields[name].clean(values)
+                except django_forms.ValidationError as e:
+                    yield (index, name, None, e.messages,)
+                else:
+                    yield (index, name, value, None,)
+
+def parse_bulk_post(request, prefix, split_fields, extra_fields=(),
+        chunk_size=CHUNK_SIZE):
+    post = BulkPost(prefix, split_fields, extra_fields)
+    if hasattr(request, '_post'):
+        # parsed already, by CsrfViewMiddleware or the view
+        return post.feed_query_dict(request._post)
+    content_type = request.META.get('CONTENT_TYPE', '')
+    if not content_type.startswith('application/x-www-form-urlencoded'):
+        # multipart and other bodies go through django's own parsers
+        return post.feed_query_dict(request.POST)
+    encoding = getattr(request, 'encoding', None) or 'utf-8'
+    return post.feed(request, chunk_size, encoding)
+
+def enforce_csrf(request, post):
+    # CsrfViewMiddleware's check for a csrf_exempt view, on the pairs kept
+    # from the body; raises PermissionDenied when it rejects the request
+    from django.core.exceptions import PermissionDenied
+    from django.http import QueryDict
+    from django.middleware.csrf import CsrfViewMiddleware
+
+    if not hasattr(request, '_post'):
+        query_dict = QueryDict('', mutable=True)
+        query_dict.update(post.data)
+        request._post = query_dict
+    if CsrfViewMiddleware().process_view(request, None, (), {}) is not None:
+        raise PermissionDenied('CSRF verification failed.')
+
+def bulk_formset(formset_class, request, prefix, split_fields,
+        extra_fields=(), check_csrf=False, **kwargs):
+    model = getattr(formset_class, 'model', None)
+    if model is not None:
+        extra_fields = tuple(extra_fields) + (model._meta.pk.name,)
+    post = parse_bulk_post(request, prefix, split_fields, extra_fields)
+    if check_csrf:
+        enforce_csrf(request, post)
+    return formset_class(post.data, prefix=prefix, **kwargs)
+
+if __name__ == '__main__':
+    import os, sys
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'tests',
+        'django_more_forms_tests',))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_more_forms_tests.settings'
+
+    import unittest
+    from io import BytesIO
+    from urllib import urlencode
+    from django import forms as django_forms
+    from django.http import QueryDict
+    from django.test import SimpleTestCase
+    from django.core.exceptions import PermissionDenied
+    from django.middleware.csrf import CsrfViewMiddleware
+    from django.test.client import RequestFactory
+    from django.views.decorators.csrf import csrf_exempt
+
+    import time_forms
+    import datetime_forms
+
+    class SlotForm(datetime_forms.DurationForm):
+
+        start = datetime_forms.SplitDateTimeField()
+        at = time_forms.SplitTimeField(required=False)
+
+    SlotFormSet = django_forms.formsets.formset_factory(SlotForm, extra=0)
+
+    TOKEN = 'a' * 32
+
+    def view(request):
+        pass
+
+    class BulkPostTest(SimpleTestCase):
+
+        def setUp(self):
+            pairs = [
+                ('csrfmiddlewaretoken', 'abc'),
+                ('slots-TOTAL_FORMS', '2'),
+                ('slots-INITIAL_FORMS', '0'),
+                ('slots-MAX_NUM_FORMS', ''),]
+            for i, row in enumerate((
+                    ['3', '1', '2013', '9', '30', 'am'],
+                    ['12', '31', '2013', '11', '55', 'pm'],)):
+                for j, value in enumerate(row):
+                    pairs.append(('slots-{0}-start_{1}'.format(i, j), value))
+                pairs.append(('slots-{0}-time_amount'.format(i), '1'))
+                pairs.append(('slots-{0}-time_metric'.format(i), 'hour'))
+                pairs.append(('slots-{0}-note'.format(i), u'caf\xe9 & co'
+                    .encode('utf-8')))
+            self.body = urlencode(pairs)
+
+        def test_iter_pairs_across_chunks(self):
+            for chunk_size in (1, 7, 1024):
+                pairs = list(iter_pairs(BytesIO(self.body), chunk_size))
+                self.assertEqual(b'&'.join(b'='.join(pair) for pair in pairs),
+                    self.body)
+
+        def test_groups_and_data(self):
+            post = BulkPost('slots', ['start', 'at'],
+                ['time_amount', 'time_metric']).feed(BytesIO(self.body), 5)
+            self.assertEqual(post.groups[1]['start'],
+                ['12', '31', '2013', '11', '55', 'pm'])
+            self.assertEqual(post.skipped, 2)
+            query_dict = QueryDict(self.body)
+            for key, value in post.data.items():
+                self.assertEqual(query_dict[key], value)
+            self.assertNotIn('slots-0-note', post.data)
+
+        def test_iter_clean(self):
+            post = BulkPost('slots', ['start']).feed(BytesIO(self.body))
+            records = list(post.iter_clean(
+                {'start': datetime_forms.SplitDateTimeField()}))
+            self.assertEqual(len(records), 2)
+            self.assertEqual(records[1][2].hour, 23)
+            self.assertEqual(records[1][3], None)
+
+        def test_bulk_formset(self):
+            request = RequestFactory().post('/', self.body,
+                content_type='application/x-www-form-urlencoded')
+            formset = bulk_formset(SlotFormSet, request, 'slots',
+                ['start', 'at'], ['time_amount', 'time_metric'])
+            self.assertTrue(formset.is_valid())
+            expected = SlotFormSet(QueryDict(self.body), prefix='slots')
+            self.assertTrue(expected.is_valid())
+            self.assertEqual(formset.cleaned_data, expected.cleaned_data)
+
+        def post_request(self, body, **extra):
+            request = RequestFactory().post('/', body,
+                content_type='application/x-www-form-urlencoded', **extra)
+            request.COOKIES['csrftoken'] = TOKEN
+            return request
+
+        def test_behind_csrf_middleware(self):
+            # the QueryDict the middleware parsed is used, not the stream
+            request = self.post_request(self.body.replace('abc', TOKEN))
+            self.assertEqual(CsrfViewMiddleware().process_view(request, view,
+                (), {}), None)
+            self.assertTrue(hasattr(request, '_post'))
+            request._stream = None
+            formset = bulk_formset(SlotFormSet, request, 'slots',
+                ['start', 'at'], ['time_amount', 'time_metric'])
+            self.assertTrue(formset.is_valid())
+            expected = SlotFormSet(QueryDict(self.body), prefix='slots')
+            self.assertTrue(expected.is_valid())
+            self.assertEqual(formset.cleaned_data, expected.cleaned_data)
+
+        def test_csrf_exempt_header_token(self):
+            exempt = csrf_exempt(view)
+            body = self.body.replace('csrfmiddlewaretoken=abc&', '')
+            for token, allowed in ((TOKEN, True,), ('b' * 32, False,)):
+                request = self.post_request(body, HTTP_X_CSRFTOKEN=token)
+                self.assertEqual(CsrfViewMiddleware().process_view(request,
+                    exempt, (), {}), None)
+                self.assertFalse(hasattr(request, '_post'))
+                if allowed:
+                    formset = bulk_formset(SlotFormSet, request, 'slots',
+                        ['start', 'at'], ['time_amount', 'time_metric'],
+                        check_csrf=True)
+                    self.assertTrue(formset.is_valid())
+                else:
+                    self.assertRaises(PermissionDenied, bulk_formset,
+                        SlotFormSet, request, 'slots', ['start'],
+                        check_csrf=True)
+
+        def test_csrf_exempt_body_token(self):
+            request = self.post_request(self.body.replace('abc', TOKEN))
+            formset = bulk_formset(SlotFormSet, request, 'slots',
+                ['start', 'at'], ['time_amount', 'time_metric'],
+                check_csrf=True)
+            self.assertTrue(formset.is_valid())
+            request = self.post_request(self.body)
+            self.assertRaises(PermissionDenied, bulk_formset, SlotFormSet,
+                request, 'slots', ['start'], check_csrf=True)
+
+        def test_multipart(self):
+            request = RequestFactory().post('/', QueryDict(self.body))
+            self.assertTrue(request.META['CONTENT_TYPE'].startswith(
+                'multipart/form-data'))
+            formset = bulk_formset(SlotFormSet, request, 'slots',
+                ['start', 'at'], ['time_amount', 'time_metric'])
+            self.assertTrue(formset.is_valid())
+            expected = SlotFormSet(QueryDict(self.body), prefix='slots')
+            self.assertTrue(expected.is_valid())
+            self.assertEqual(formset.cleaned_data, expected.cleaned_data)
+
+        def test_malformed_bytes(self):
+            body = self.body + '&slots-0-time_metric=%FF%FE&%FF%FE=1'
+            post = BulkPost('slots', ['start'], ['time_metric']).feed(
+                BytesIO(body))
+            self.assertEqual(post.data['slots-0-time_metric'],
+                QueryDict(body)['slots-0-time_metric'])
+            # the notes, the amounts and the undecodable key
+            self.assertEqual(post.skipped, 5)
+
+        def test_formset_fields_kept(self):
+            body = self.body + '&' + urlencode([('slots-0-id', '7'),
+                ('slots-1-id', '8'), ('slots-1-DELETE', 'on'),
+                ('slots-0-ORDER', '2'), ('slots-1-ORDER', '1')])
+            post = BulkPost('slots', ['start']).feed(BytesIO(body))
+            for key in ('slots-0-id', 'slots-1-DELETE', 'slots-1-ORDER',):
+                self.assertEqual(post.data[key], QueryDict(body)[key])
+
+            FormSet = django_forms.formsets.formset_factory(SlotForm,
+                extra=0, can_delete=True, can_order=True)
+            request = RequestFactory().post('/', body,
+                content_type='application/x-www-form-urlencoded')
+            formset = bulk_formset(FormSet, request, 'slots', ['start', 'at'],
+                ['time_amount', 'time_metric'])
+            self.assertTrue(formset.is_valid())
+            self.assertEqual([form.prefix for form in formset.deleted_forms],
+                ['slots-1'])
+            self.assertEqual([form.prefix for form in formset.ordered_forms],
+                ['slots-0'])
+
+    unittest.main()
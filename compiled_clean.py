@@ -0,0 +1,262 @@
+import functools
+
+from django import forms as django_forms
+from django.utils.encoding import force_text
+
+import time_forms
+import datetime_forms
+
+# Opt-in fast clean for forms using the split fields:
+#
+#     @compiled_clean
+#     class EventForm(django_forms.Form):
+#         start = datetime_forms.SplitDateTimeField()
+#
+# Each split field (and plain ChoiceField, such as DurationForm's
+# time_metric) gets a clean function specialized once per form class, with
+# its choices folded into sets. Values that are all valid choices take the
+# fast path straight to compress(); anything else falls back to the field's
+# own clean so errors, messages and exceptions stay identical. Choices are
+# read when the class is decorated, like base_fields themselves; a form
+# instance whose choices differ from those (narrowed in __init__, or
+# replaced later) is cleaned the generic way.
+
+SPLIT_FIELD_CLASSES = (
+    time_forms.SplitTimeField,
+    datetime_forms.SplitDateField,
+    datetime_forms.SplitDateTimeField,)
+
+TEXT_TYPES = (str, unicode,)
+
+def _valid_texts(choice_field):
+    texts = set()
+    for key, label in choice_field.choices:
+        if isinstance(label, (list, tuple,)):
+            texts.update(force_text(group_key) for group_key, group_label
+                in label)
+        else:
+            texts.add(force_text(key))
+    # empty values always go through the generic path
+    texts.discard(u'')
+    return frozenset(texts)
+
+def _is_plain_choice_field(field):
+    return field.__class__ is django_forms.ChoiceField and \
+        not field.validators
+
+def field_choices(field):
+    # the choices lists the compiled sets are built from
+    if isinstance(field, SPLIT_FIELD_CLASSES):
+        return tuple(f.choices for f in field.fields)
+    return (field.choices,)
+
+def _same_choices(field, choices):
+    for current, expected in zip(field_choices(field), choices):
+        if current is not expected:
+            return False
+    return True
+
+def compile_split_field(field):
+    if not all(_is_plain_choice_field(f) for f in field.fields):
+        return None
+    valid = tuple(_valid_texts(f) for f in field.fields)
+    size = len(valid)
+    generic_clean = field.__class__.clean
+
+    def clean(field, choices, value):
+        if not _same_choices(field, choices):
+            return generic_clean(field, value)
+        if value.__class__ in (list, tuple,) and len(value) == size:
+            clean_data = []
+            for sub_value, texts in zip(value, valid):
+                if sub_value.__class__ not in TEXT_TYPES or \
+                        sub_value not in texts:
+                    return generic_clean(field, value)
+                clean_data.append(force_text(sub_value))
+            out = field.compress(clean_data)
+            field.validate(out)
+            field.run_validators(out)
+            return out
+        return generic_clean(field, value)
+    return clean
+
+def compile_choice_field(field):
+    if not _is_plain_choice_field(field):
+        return None
+    texts = _valid_texts(field)
+    generic_clean = field.__class__.clean
+
+    def clean(field, choices, value):
+        if field.choices is not choices[0]:
+            return generic_clean(field, value)
+        if value.__class__ in TEXT_TYPES and value in texts:
+            return force_text(value)
+        return generic_clean(field, value)
+    return clean
+
+def compile_field(field):
+    if isinstance(field, SPLIT_FIELD_CLASSES):
+        return compile_split_field(field)
+    if isinstance(field, django_forms.ChoiceField):
+        return compile_choice_field(field)
+    return None
+
+def compiled_clean(form_class):
+    compiled = {}
+    for name, field in form_class.base_fields.items():
+        clean = compile_field(field)
+        if clean is not None:
+            compiled[name] = (field, clean,
+                tuple(list(choices) for choices in field_choices(field)),)
+
+    original_init = form_class.__init__
+
+    def __init__(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        for name, (base_field, clean, base_choices) in compiled.items():
+            # skip fields a subclass redeclared
+            if self.base_fields.get(name, None) is not base_field:
+                continue
+            field = self.fields.get(name, None)
+            if field is None or field.__class__ is not base_field.__class__:
+                continue
+            # the copies made for this form, as long as they still hold
+            # the choices the sets were built from
+            choices = field_choices(field)
+            if [list(c) for c in choices] == list(base_choices):
+                field.clean = functools.partial(clean, field, choices)
+
+    functools.update_wrapper(__init__, original_init)
+    form_class.__init__ = __init__
+    form_class.compiled_fields = tuple(sorted(compiled))
+    return form_class
+
+if __name__ == '__main__':
+    import os, sys
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'tests',
+        'django_more_forms_tests',))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_more_forms_tests.settings'
+
+    import itertools
+    import unittest
+    from django.test import SimpleTestCase
+
+    class EventForm(datetime_forms.DurationForm):
+
+        start = datetime_forms.SplitDateTimeField()
+        day = datetime_forms.SplitDateField(required=False)
+        at = time_forms.SplitTimeField()
+
+    @compiled_clean
+    class CompiledEventForm(EventForm):
+        pass
+
+    def outcome(clean, value):
+        try:
+            return ('value', clean(value),)
+        except django_forms.ValidationError as e:
+            return ('error', e.messages,)
+        except Exception as e:
+            return ('exception', e.__class__, str(e),)
+
+    class CompiledCleanTest(SimpleTestCase):
+
+        def test_compiled_fields(self):
+            self.assertEqual(CompiledEventForm.compiled_fields,
+                ('at', 'day', 'start', 'time_metric',))
+            form = CompiledEventForm()
+            self.assertTrue(isinstance(form.fields['at'].clean,
+                functools.partial))
+            self.assertFalse(isinstance(EventForm().fields['at'].clean,
+                functools.partial))
+
+        def test_split_time_equivalence(self):
+            generic = EventForm().fields['at']
+            compiled = CompiledEventForm().fields['at']
+            samples = ['1', '12', '13', '0', '5', '7', 'am', 'pm', 'xm', '',
+                None, u'10', 5]
+            for value in itertools.product(samples, repeat=3):
+                for value in (list(value), tuple(value),):
+                    self.assertEqual(outcome(compiled.clean, value),
+                        outcome(generic.clean, value), value)
+            for value in ([], None, '', ['1', '5'], ['1', '5', 'am', 'x'],
+                    'not a list', {}):
+                self.assertEqual(outcome(compiled.clean, value),
+                    outcome(generic.clean, value), value)
+
+        def test_split_date_equivalence(self):
+            generic = EventForm().fields['day']
+            compiled = CompiledEventForm().fields['day']
+            samples = ['2', '13', '29', '30', '31', '2012', '2013', '1999',
+                '', None]
+            for value in itertools.product(samples, repeat=3):
+                self.assertEqual(outcome(compiled.clean, list(value)),
+                    outcome(generic.clean, list(value)), value)
+
+        def test_split_datetime_equivalence(self):
+            generic = EventForm().fields['start']
+            compiled = CompiledEventForm().fields['start']
+            for value in (
+                    ['3', '1', '2013', '9', '30', 'am'],
+                    ['3', '10', '2013', '2', '0', 'am'],
+                    ['11', '3', '2013', '1', '30', 'am'],
+                    ['2', '30', '2013', '9', '30', 'am'],
+                    ['3', '1', '2013', '9', '31', 'am'],
+                    ['3', '1', '2013', '', '30', 'am'],
+                    ['', '', '', '', '', ''],
+                    [3, 1, 2013, 9, 30, 'am'],):
+                self.assertEqual(outcome(compiled.clean, value),
+                    outcome(generic.clean, value), value)
+
+        def test_narrowed_choices(self):
+            class NarrowedForm(CompiledEventForm):
+                def __init__(self, *args, **kwargs):
+                    super(NarrowedForm, self).__init__(*args, **kwargs)
+                    self.fields['time_metric'].choices = [('min', 'min',)]
+                    self.fields['at'].fields[2].choices = [('am', 'AM',)]
+
+            form = NarrowedForm()
+            generic = EventForm()
+            generic.fields['time_metric'].choices = [('min', 'min',)]
+            generic.fields['at'].fields[2].choices = [('am', 'AM',)]
+            for name, value in (('time_metric', 'hour',),
+                    ('at', ['1', '5', 'pm'],), ('at', ['1', '5', 'am'],)):
+                self.assertEqual(outcome(form.fields[name].clean, value),
+                    outcome(generic.fields[name].clean, value), value)
+            self.assertEqual(outcome(form.fields['at'].clean,
+                ['1', '5', 'pm'])[0], 'error')
+
+        def test_choices_changed_later(self):
+            form = CompiledEventForm()
+            self.assertTrue(isinstance(form.fields['day'].clean,
+                functools.partial))
+            form.fields['day'].fields[2].choices = [('2013', '2013',)]
+            generic = EventForm()
+            generic.fields['day'].fields[2].choices = [('2013', '2013',)]
+            for value in (['3', '1', '2012'], ['3', '1', '2013']):
+                self.assertEqual(outcome(form.fields['day'].clean, value),
+                    outcome(generic.fields['day'].clean, value), value)
+            form.fields['time_metric'].choices = [('min', 'min',)]
+            self.assertEqual(outcome(form.fields['time_metric'].clean,
+                'hour')[0], 'error')
+
+        def test_form_equivalence(self):
+            for data in (
+                    {'start_0': '3', 'start_1': '1', 'start_2': '2013',
+                        'start_3': '9', 'start_4': '30', 'start_5': 'am',
+                        'at_0': '1', 'at_1': '5', 'at_2': 'pm',
+                        'time_amount': '2', 'time_metric': 'hour'},
+                    {'start_0': '3', 'start_1': '1', 'start_2': '2013',
+                        'start_3': '13', 'start_4': '30', 'start_5': 'am',
+                        'at_0': '1', 'at_2': 'pm',
+                        'time_amount': '0', 'time_metric': 'min'},
+                    {},):
+                generic = EventForm(data)
+                compiled = CompiledEventForm(data)
+                self.assertEqual(compiled.is_valid(), generic.is_valid())
+                self.assertEqual(compiled.errors, generic.errors)
+                self.assertEqual(compiled.cleaned_data, generic.cleaned_data)
+
+    unittest.main()
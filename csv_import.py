@@ -0,0 +1,170 @@
+import csv
+import time
+import itertools
+
+import pytz
+from django import forms as django_forms
+
+import datetime_forms
+
+# column names in SplitDateTimeField sub-field order
+SPLIT_DATETIME_COLUMNS = ('month', 'day', 'year', 'hour', 'minute', 'ampm',)
+
+# rows whose selects are all valid choices but don't name a real local time
+INVALID_DATE_MESSAGE = 'Not a valid date: {0}'
+INVALID_TIME_MESSAGE = 'Not a valid time in the current time zone: {0}'
+
+class ImportStats(object):
+
+    def __init__(self):
+        self.rows = 0
+        self.valid = 0
+        self.invalid = 0
+        self.chunks = 0
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0.0
+        return self.rows / elapsed
+
+    def __repr__(self):
+        return '<ImportStats rows={0} valid={1} invalid={2} rows/s={3:.0f}>'\
+            .format(self.rows, self.valid, self.invalid,
+                self.rows_per_second)
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def iter_split_datetimes(stream, columns=SPLIT_DATETIME_COLUMNS,
+        chunk_size=1000, field=None, stats=None):
+    # Reads a csv stream with a header row and yields
+    # (line_number, value, errors) records, where value is the cleaned
+    # datetime or None and errors the validation messages. Only one chunk
+    # of rows is held in memory at a time; pass an ImportStats to follow
+    # throughput.
+    if field is None:
+        field = datetime_forms.SplitDateTimeField()
+    if stats is None:
+        stats = ImportStats()
+
+    reader = csv.DictReader(stream)
+    rows = ((reader.line_num, row) for row in reader)
+    for chunk in iter_chunks(rows, chunk_size):
+        stats.chunks += 1
+        for line_number, row in chunk:
+            stats.rows += 1
+            values = [(row.get(column, None) or '').strip()
+                for column in columns]
+            try:
+                value = field.clean(values)
+            except django_forms.ValidationError as e:
+                stats.invalid += 1
+                yield (line_number, None, e.messages,)
+            except pytz.InvalidTimeError as e:
+                # skipped or repeated by a dst change
+                stats.invalid += 1
+                yield (line_number, None, [INVALID_TIME_MESSAGE.format(e)],)
+            except ValueError as e:
+                # e.g. February 30th, rejected by strptime in compress
+                stats.invalid += 1
+                yield (line_number, None, [INVALID_DATE_MESSAGE.format(e)],)
+            else:
+                stats.valid += 1
+                yield (line_number, value, None,)
+    stats.finished = time.time()
+
+if __name__ == '__main__':
+    import os, sys
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'tests',
+        'django_more_forms_tests',))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_more_forms_tests.settings'
+
+    import datetime
+    import unittest
+    from StringIO import StringIO
+    from django.test import SimpleTestCase
+    from django.utils import timezone
+
+    class IterSplitDateTimesTest(SimpleTestCase):
+
+        def setUp(self):
+            self.stream = StringIO(
+                'month,day,year,hour,minute,ampm\r\n'
+                '3,1,2013,9,30,am\r\n'
+                '3,1,2013,13,30,pm\r\n'
+                '12,31,2013,12,0,pm\r\n')
+
+        def test_values_and_errors(self):
+            records = list(iter_split_datetimes(self.stream, chunk_size=2))
+            self.assertEqual(len(records), 3)
+
+            line_number, value, errors = records[0]
+            self.assertEqual(line_number, 2)
+            self.assertEqual(errors, None)
+            self.assertEqual(timezone.localtime(value).replace(tzinfo=None),
+                datetime.datetime(2013, 3, 1, 9, 30))
+
+            line_number, value, errors = records[1]
+            self.assertEqual(line_number, 3)
+            self.assertEqual(value, None)
+            self.assertTrue(errors)
+
+            self.assertEqual(records[2][1].hour, 12)
+
+        def test_stats(self):
+            stats = ImportStats()
+            for record in iter_split_datetimes(self.stream, chunk_size=2,
+                    stats=stats):
+                pass
+            self.assertEqual(stats.rows, 3)
+            self.assertEqual(stats.valid, 2)
+            self.assertEqual(stats.invalid, 1)
+            self.assertEqual(stats.chunks, 2)
+            self.assertTrue(stats.finished)
+            self.assertTrue(stats.rows_per_second >= 0)
+
+        def test_is_lazy(self):
+            records = iter_split_datetimes(self.stream, chunk_size=1)
+            next(records)
+            self.assertTrue(self.stream.tell() < len(self.stream.getvalue()))
+
+        def test_impossible_dates(self):
+            stream = StringIO(
+                'month,day,year,hour,minute,ampm\r\n'
+                '2,30,2013,9,30,am\r\n'
+                '3,10,2013,2,30,am\r\n'
+                '11,3,2013,1,30,am\r\n'
+                '3,1,2013,9,30,am\r\n')
+            stats = ImportStats()
+            with timezone.override(pytz.timezone('America/New_York')):
+                records = list(iter_split_datetimes(stream, stats=stats))
+            self.assertEqual([record[0] for record in records], [2, 3, 4, 5])
+            self.assertIn('day is out of range', records[0][2][0])
+            # dst gap and the repeated hour
+            self.assertIn('current time zone', records[1][2][0])
+            self.assertIn('current time zone', records[2][2][0])
+            self.assertEqual(records[3][2], None)
+            self.assertEqual((stats.valid, stats.invalid,), (1, 3,))
+
+        def test_custom_columns(self):
+            stream = StringIO('m,d,y,h,mi,p\r\n1,2,2013,1,5,pm\r\n')
+            records = list(iter_split_datetimes(stream,
+                columns=('m', 'd', 'y', 'h', 'mi', 'p',)))
+            self.assertEqual(records[0][2], None)
+
+    unittest.main()
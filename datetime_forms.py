@@ -1,4 +1,6 @@
+import re
 import math
+import heapq
 import datetime
 import itertools
 
@@ -6,9 +8,12 @@ import pytz
 from django.utils import timezone
 from django.forms import widgets as django_widgets
 from django import forms as django_forms
+from django.forms.formsets import BaseFormSet
+from django.forms.models import BaseModelFormSet
 from django.utils.safestring import mark_safe
 
 import time_forms
+import form_tables
 
 class DateOptionChoices(object):
 
@@ -16,35 +21,50 @@ class DateOptionChoices(object):
 
     @classmethod
     def months(cls):
+        months = form_tables.get_choices('months')
+        if months is not None:
+            return months
         months = [(x, datetime.date(month=x,day=1,year=2010).strftime('%B'),) for x in xrange(1, 13)]
         months.insert(0, cls.BLANK_CHOICE)
         return months
 
     @classmethod
     def days(cls):
+        days = form_tables.get_choices('days')
+        if days is not None:
+            return days
         days = [(x, x,) for x in xrange(1, 32)]
         days.insert(0, cls.BLANK_CHOICE)
         return days
 
     @classmethod
     def years(cls):
+        years = form_tables.get_choices('years')
+        if years is not None and years[-1][0] == timezone.now().year:
+            return years
         years = [(x, x,) for x in xrange(2010, timezone.now().year+1)]
         years.insert(0, cls.BLANK_CHOICE)
         return years
 
-class MonthSelectWidget(django_widgets.Select):
+class MonthSelectWidget(form_tables.TableOptionsMixin, django_widgets.Select):
+
+    table_name = 'months'
 
     def __init__(self, attrs={'class': 'months-select'}):
         super(MonthSelectWidget, self).__init__(attrs)
         self.choices = DateOptionChoices.months()
 
-class DaySelectWidget(django_widgets.Select):
+class DaySelectWidget(form_tables.TableOptionsMixin, django_widgets.Select):
+
+    table_name = 'days'
 
     def __init__(self, attrs={'class': 'days-select'}):
         super(DaySelectWidget, self).__init__(attrs)
         self.choices = DateOptionChoices.days()
 
-class YearSelectWidget(django_widgets.Select):
+class YearSelectWidget(form_tables.TableOptionsMixin, django_widgets.Select):
+
+    table_name = 'years'
 
     def __init__(self, attrs={'class': 'years-select' }):
         super(YearSelectWidget, self).__init__(attrs)
@@ -136,11 +156,18 @@ class SplitDateTimeSelectWidget(django_widgets.MultiWidget):
         time_html = time_html.replace('<select class="datetimeselect-time" name="datetime_3"', '</div><div class="control-group"><select class="datetimeselect-time" name="datetime_3"')
         return mark_safe(date_html + time_html)
 
+    memo = time_forms.DecompressMemo()
+
     def decompress(self, value):
         if not value:
             return None
 
         if value:
+            key = (timezone.get_current_timezone(),
+                time_forms.minute_bucket(value, 5),)
+            result = self.memo.get(key)
+            if result is not None:
+                return result
             if not timezone.is_aware(value):
                 value = datetime.datetime(
                     month=value.month,
@@ -151,15 +178,18 @@ class SplitDateTimeSelectWidget(django_widgets.MultiWidget):
                     second=value.second,
                     tzinfo=pytz.utc)
             value = timezone.localtime(value)
-            return [
+            result = (
                 value.month,
                 value.day,
                 value.year,
                 int(value.strftime("%I")),
-                round_to_five_minutes(value.strftime("%M")),
-                value.strftime("%p").lower()]
+                time_forms.round_to_five_minutes(value.strftime("%M")),
+                value.strftime("%p").lower(),)
+            if time_forms.offset_fits(value, 5):
+                self.memo.set(key, result)
+            return result
 
-        return [None, None, None, None, None, None]
+        return (None, None, None, None, None, None,)
 
 class SplitDateTimeField(django_forms.MultiValueField):
 
@@ -185,6 +215,138 @@ class SplitDateTimeField(django_forms.MultiValueField):
                 timezone.get_current_timezone())
             return result
 
+# native html5 inputs
+
+# YYYY-MM-DD as sent by <input type="date"> and YYYY-MM-DDTHH:MM[:SS] as
+# sent by <input type="datetime-local">, checked before parsing like
+# time_forms.ISO_TIME
+ISO_DATE = re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}\Z')
+ISO_DATETIME = re.compile(
+    r'^[0-9]{4}-[0-9]{2}-[0-9]{2}[T ][0-9]{2}:[0-9]{2}(:[0-9]{2})?\Z')
+
+def _parse_iso_date(value):
+    return datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+
+def _parse_iso_datetime(value):
+    return datetime.datetime.combine(_parse_iso_date(value[:10]),
+        time_forms._parse_iso_time(value[11:]))
+
+# the C implemented parsers when the running python has them
+_date_from_iso = getattr(datetime.date, 'fromisoformat', _parse_iso_date)
+_datetime_from_iso = getattr(datetime.datetime, 'fromisoformat',
+    _parse_iso_datetime)
+
+def parse_iso_date(value):
+    if not ISO_DATE.match(value):
+        raise ValueError('Invalid isoformat string: {0!r}'.format(value))
+    return _date_from_iso(value)
+
+def parse_iso_datetime(value):
+    if not ISO_DATETIME.match(value):
+        raise ValueError('Invalid isoformat string: {0!r}'.format(value))
+    return _datetime_from_iso(value)
+
+class NativeDateInput(django_widgets.TextInput):
+
+    input_type = 'date'
+
+    def __init__(self, attrs={'class': 'date-input'}):
+        super(NativeDateInput, self).__init__(attrs)
+
+    def _format_value(self, value):
+        if isinstance(value, datetime.date):
+            return '%04d-%02d-%02d' % (value.year, value.month, value.day)
+        return value
+
+class NativeDateField(django_forms.Field):
+
+    # single <input type="date"> alternative to SplitDateField; limited to
+    # the years the year select offers unless all_years is set
+
+    widget = NativeDateInput
+    default_error_messages = {
+        'invalid': 'Enter a valid date.',}
+
+    def __init__(self, *args, **kwargs):
+        self.all_years = kwargs.pop('all_years', False)
+        super(NativeDateField, self).__init__(*args, **kwargs)
+
+    def check_year(self, value):
+        if self.all_years:
+            return
+        years = [year for year, label in DateOptionChoices.years() if year]
+        if value.year < min(years) or value.year > max(years):
+            raise django_forms.ValidationError(self.error_messages['invalid'])
+
+    def to_python(self, value):
+        if value in django_forms.fields.EMPTY_VALUES:
+            return None
+        if isinstance(value, datetime.datetime):
+            return value.date()
+        if isinstance(value, datetime.date):
+            return value
+        try:
+            return parse_iso_date(value.strip())
+        except (ValueError, TypeError, AttributeError):
+            raise django_forms.ValidationError(self.error_messages['invalid'])
+
+    def validate(self, value):
+        super(NativeDateField, self).validate(value)
+        if value is not None:
+            self.check_year(value)
+
+class NativeDateTimeInput(django_widgets.TextInput):
+
+    input_type = 'datetime-local'
+
+    def __init__(self, attrs={'class': 'datetime-input'}, step=5):
+        super(NativeDateTimeInput, self).__init__(attrs)
+        self.step = step
+        self.attrs['step'] = step * 60
+
+    def _format_value(self, value):
+        if isinstance(value, datetime.datetime):
+            # naive values are taken as utc, like the split widget
+            if not timezone.is_aware(value):
+                value = value.replace(tzinfo=pytz.utc)
+            value = timezone.localtime(value)
+            return '%04d-%02d-%02dT%02d:%02d' % (value.year, value.month,
+                value.day, value.hour, value.minute // self.step * self.step)
+        return value
+
+class NativeDateTimeField(NativeDateField):
+
+    # single <input type="datetime-local"> alternative to
+    # SplitDateTimeField, cleaning to the same aware datetime in the
+    # current time zone
+
+    default_error_messages = {
+        'invalid': 'Enter a valid date/time.',}
+
+    def __init__(self, *args, **kwargs):
+        self.step = kwargs.pop('step', 5)
+        if 'widget' not in kwargs:
+            kwargs['widget'] = NativeDateTimeInput(step=self.step)
+        super(NativeDateTimeField, self).__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        if value in django_forms.fields.EMPTY_VALUES:
+            return None
+        if isinstance(value, datetime.datetime):
+            if timezone.is_aware(value):
+                return value
+        else:
+            try:
+                value = parse_iso_datetime(value.strip())
+            except (ValueError, TypeError, AttributeError):
+                raise django_forms.ValidationError(
+                    self.error_messages['invalid'])
+            if value.tzinfo is not None or value.second or \
+                    value.microsecond or value.minute % self.step:
+                raise django_forms.ValidationError(
+                    self.error_messages['invalid'])
+        return timezone.make_aware(value, timezone.get_current_timezone())
+
 # django datetime form helper
 
 class TimeStampSet(object):
@@ -242,6 +404,68 @@ class TimeStampSet(object):
                     { field_name: timezone.now().time() })
         return kwargs
 
+    @classmethod
+    def _bulk_initial(cls, instances, datetime_fields=(), time_fields=()):
+        # initial dicts for many instances at once, one per instance in
+        # order, holding what _set_datetime_on and _set_time_on would set on
+        # each form's kwargs. A queryset that isn't evaluated yet only
+        # fetches those columns; each distinct datetime is converted once.
+        field_names = tuple(datetime_fields) + tuple(time_fields)
+        if field_names and hasattr(instances, 'values_list') and \
+                getattr(instances, '_result_cache', None) is None:
+            rows = instances.values_list(*field_names)
+        else:
+            rows = [tuple(getattr(instance, field_name)
+                for field_name in field_names) for instance in instances]
+
+        current_timezone = timezone.get_current_timezone()
+        converted = {}
+        split = len(datetime_fields)
+        initials = []
+        for row in rows:
+            initial = {}
+            for field_name, dt in itertools.izip(datetime_fields, row):
+                if dt is not None:
+                    try:
+                        new_dt = converted[dt]
+                    except KeyError:
+                        new_dt = converted[dt] = dt.astimezone(
+                            current_timezone)
+                    initial[field_name] = new_dt
+            initial.update(itertools.izip(time_fields, row[split:]))
+            initials.append(initial)
+        return initials
+
+class TimeStampModelFormSet(BaseModelFormSet):
+
+    # model formset whose forms start from the instances' datetimes in the
+    # current time zone, like TimeStampSet._set_datetime_on and
+    # _set_time_on, converted for all forms at once from the queryset the
+    # formset loads anyway
+
+    datetime_fields = ()
+    time_fields = ()
+
+    def _time_stamp_initials(self):
+        try:
+            return self._time_stamp_initial_map
+        except AttributeError:
+            pass
+        # the formset's own, already evaluated, queryset
+        instances = list(self.get_queryset())
+        initials = TimeStampSet._bulk_initial(instances,
+            self.datetime_fields, self.time_fields)
+        self._time_stamp_initial_map = dict((instance.pk, initial,)
+            for instance, initial in itertools.izip(instances, initials))
+        return self._time_stamp_initial_map
+
+    def _construct_form(self, i, **kwargs):
+        form = super(TimeStampModelFormSet, self)._construct_form(i, **kwargs)
+        if i < self.initial_form_count() and form.instance.pk is not None:
+            form.initial.update(self._time_stamp_initials().get(
+                form.instance.pk, {}))
+        return form
+
 # duration
 
 def _get_time_metric_choices():
@@ -250,6 +474,16 @@ def _get_time_metric_choices():
         ('hour', 'Hours',),)
     return TIME_METRIC_CHOICES
 
+TIME_METRIC_MINUTES = {
+    'min': 1,
+    'hour': 60,}
+
+def duration_to_timedelta(time_amount, time_metric):
+    if time_amount is None or not time_metric:
+        return None
+    return datetime.timedelta(
+        minutes=time_amount * TIME_METRIC_MINUTES[time_metric])
+
 class DurationForm(django_forms.Form):
 
     time_amount = django_forms.IntegerField(required=False, label="",
@@ -259,16 +493,260 @@ class DurationForm(django_forms.Form):
 
     def clean(self):
         cleaned_data = super(DurationForm, self).clean()
-        any_filled = any(cleaned_data.get(field_name, None) is not None for field_name in ('time_amount', 'time_metric',))
-        all_filled = all(cleaned_data.get(field_name, None) is not None for field_name in ('time_amount', 'time_metric',))
+        # '' from an empty metric select is as unfilled as None
+        filled = [cleaned_data.get(field_name, None) not in
+            django_forms.fields.EMPTY_VALUES
+            for field_name in ('time_amount', 'time_metric',)]
+        any_filled = any(filled)
+        all_filled = all(filled)
         if any_filled and not all_filled:
             msg = 'Invalid Time Spent'
             self._errors['time_amount'] = self.error_class([msg])
             self._errors['time_metric'] = self.error_class([msg])
-            del cleaned_data['time_amount']
-            del cleaned_data['time_metric']
+            cleaned_data.pop('time_amount', None)
+            cleaned_data.pop('time_metric', None)
+        cleaned_data['time_delta'] = duration_to_timedelta(
+            cleaned_data.get('time_amount', None),
+            cleaned_data.get('time_metric', None))
         return cleaned_data
 
+def _distribution(low, high, mean, median):
+    return {
+        'min': datetime.timedelta(minutes=low),
+        'max': datetime.timedelta(minutes=high),
+        'mean': datetime.timedelta(minutes=mean),
+        'median': datetime.timedelta(minutes=median),}
+
+def _summarize_minutes(minutes):
+    if not minutes:
+        return None
+    ordered = sorted(minutes)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        median = ordered[middle]
+    else:
+        median = (ordered[middle - 1] + ordered[middle]) / 2.0
+    return _distribution(ordered[0], ordered[-1],
+        float(sum(ordered)) / len(ordered), median)
+
+# numpy takes longer to import than everything else here, so it is only
+# imported by the first aggregate; False until then, None when missing
+_numpy = False
+
+def get_numpy():
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+def aggregate_durations(forms):
+    # totals, per-metric sums and distribution over cleaned DurationForms;
+    # one vectorized pass when numpy is available
+    metrics = [metric for metric, label in _get_time_metric_choices()]
+    amounts = []
+    codes = []
+    for form in forms:
+        cleaned_data = getattr(form, 'cleaned_data', None) or {}
+        if cleaned_data.get('time_delta', None) is None:
+            continue
+        amounts.append(cleaned_data['time_amount'])
+        codes.append(metrics.index(cleaned_data['time_metric']))
+
+    factors = [TIME_METRIC_MINUTES[metric] for metric in metrics]
+    numpy = get_numpy() if amounts else None
+    if numpy is not None:
+        amounts_array = numpy.array(amounts, dtype=numpy.int64)
+        codes_array = numpy.array(codes, dtype=numpy.intp)
+        minutes_array = amounts_array * \
+            numpy.array(factors, dtype=numpy.int64)[codes_array]
+        metric_amounts = numpy.bincount(codes_array,
+            weights=amounts_array, minlength=len(metrics))
+        metric_counts = numpy.bincount(codes_array, minlength=len(metrics))
+        total_minutes = int(minutes_array.sum())
+        metric_amounts = [int(x) for x in metric_amounts]
+        metric_counts = [int(x) for x in metric_counts]
+        distribution = _distribution(int(minutes_array.min()),
+            int(minutes_array.max()), float(minutes_array.mean()),
+            float(numpy.median(minutes_array)))
+    else:
+        metric_amounts = [0] * len(metrics)
+        metric_counts = [0] * len(metrics)
+        minutes = []
+        for amount, code in itertools.izip(amounts, codes):
+            metric_amounts[code] += amount
+            metric_counts[code] += 1
+            minutes.append(amount * factors[code])
+        total_minutes = sum(minutes)
+        distribution = _summarize_minutes(minutes)
+
+    per_metric = {}
+    for i, metric in enumerate(metrics):
+        per_metric[metric] = {
+            'count': metric_counts[i],
+            'amount': metric_amounts[i],
+            'total': datetime.timedelta(
+                minutes=metric_amounts[i] * factors[i]),}
+    return {
+        'count': len(amounts),
+        'total': datetime.timedelta(minutes=total_minutes),
+        'per_metric': per_metric,
+        'distribution': distribution,}
+
+class DurationFormSet(BaseFormSet):
+
+    def aggregate(self):
+        forms = []
+        for form in self.forms:
+            if self.can_delete and self._should_delete_form(form):
+                continue
+            forms.append(form)
+        return aggregate_durations(forms)
+
+# scheduling
+
+def find_interval_conflicts(intervals):
+    # intervals is a list of (start, end) pairs, end may equal start.
+    # Identical intervals are grouped, then the distinct ones are sorted
+    # and swept with a heap of active end times: O(n log n) plus the
+    # number of conflicts reported, since every active group scanned
+    # overlaps the current one.
+    # Returns (overlaps, duplicates): overlaps as sorted index pairs,
+    # duplicates as one sorted index tuple per interval given more than
+    # once.
+    groups = {}
+    for i, interval in enumerate(intervals):
+        groups.setdefault(interval, []).append(i)
+
+    overlaps = []
+    duplicates = []
+    active = []
+    for interval in sorted(groups):
+        start, end = interval
+        members = groups[interval]
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        if len(members) > 1:
+            duplicates.append(tuple(members))
+        for active_end, active_members in active:
+            for j in active_members:
+                for i in members:
+                    overlaps.append((j, i) if j < i else (i, j))
+        heapq.heappush(active, (end, members))
+    return sorted(overlaps), sorted(duplicates)
+
+class ScheduleFormSet(BaseFormSet):
+
+    # each row carries a SplitDateTimeField start plus the DurationForm
+    # time_amount/time_metric fields
+
+    start_field_name = 'start'
+    overlap_message = 'Overlaps another time slot'
+    duplicate_message = 'Duplicate time slot'
+
+    def get_interval(self, form):
+        cleaned_data = getattr(form, 'cleaned_data', None) or {}
+        start = cleaned_data.get(self.start_field_name, None)
+        if start is None:
+            return None
+        time_delta = cleaned_data.get('time_delta', None)
+        if time_delta is None:
+            time_delta = datetime.timedelta(0)
+        return (start, start + time_delta)
+
+    def clean(self):
+        super(ScheduleFormSet, self).clean()
+        self.conflicts = []
+        if any(self.errors):
+            return
+
+        forms = []
+        intervals = []
+        for form in self.forms:
+            if self.can_delete and self._should_delete_form(form):
+                continue
+            interval = self.get_interval(form)
+            if interval is not None:
+                forms.append(form)
+                intervals.append(interval)
+
+        overlaps, duplicates = find_interval_conflicts(intervals)
+        for groups, msg in ((duplicates, self.duplicate_message),
+                (overlaps, self.overlap_message),):
+            for group in groups:
+                for i in group:
+                    form = forms[i]
+                    if self.start_field_name not in form._errors:
+                        form._errors[self.start_field_name] = \
+                            form.error_class()
+                    if msg not in form._errors[self.start_field_name]:
+                        form._errors[self.start_field_name].append(msg)
+                self.conflicts.append(
+                    (msg,) + tuple(forms[i].prefix for i in group))
+
+        if self.conflicts:
+            raise django_forms.ValidationError('Conflicting time slots')
+
+
+# recurrence
+
+RECURRENCE_RULES = {
+    'daily': 1,
+    'weekly': 7,}
+
+def _localize(value, tz):
+    if hasattr(tz, 'localize'):
+        return tz.normalize(tz.localize(value))
+    return value.replace(tzinfo=tz)
+
+def iter_recurrences(start, duration=None, rule='daily', count=None,
+        until=None, interval=1, window=None, tz=None):
+    # Lazily yields (start, end) pairs. Occurrences step in local wall
+    # clock time so they keep their hour across DST changes. duration is a
+    # timedelta or a cleaned DurationForm; window is a (start, end) pair
+    # that occurrences are sliced to without generating the skipped ones.
+    # Arguments are checked here, when called, not on the first next().
+    if rule not in RECURRENCE_RULES:
+        raise ValueError('Unknown recurrence rule: {0}'.format(rule))
+    if interval < 1:
+        raise ValueError('Recurrence interval must be at least 1: {0}'
+            .format(interval))
+    if tz is None:
+        tz = timezone.get_current_timezone()
+    if isinstance(duration, django_forms.Form):
+        duration = duration.cleaned_data.get('time_delta', None)
+    if duration is None:
+        duration = datetime.timedelta(0)
+    if not timezone.is_aware(start):
+        start = _localize(start, tz)
+    return _iter_recurrences(start, duration,
+        RECURRENCE_RULES[rule] * interval, count, until, window, tz)
+
+def _iter_recurrences(start, duration, step_days, count, until, window, tz):
+    local_start = timezone.localtime(start, tz).replace(tzinfo=None)
+    window_start, window_end = window or (None, None)
+
+    index = 0
+    if window_start is not None and window_start > start:
+        local_window_start = timezone.localtime(
+            window_start, tz).replace(tzinfo=None)
+        index = max(0,
+            (local_window_start - local_start).days // step_days - 1)
+
+    while count is None or index < count:
+        occurrence = _localize(
+            local_start + datetime.timedelta(days=step_days * index), tz)
+        index += 1
+        if until is not None and occurrence > until:
+            return
+        if window_end is not None and occurrence >= window_end:
+            return
+        if window_start is not None and occurrence < window_start:
+            continue
+        yield (occurrence, occurrence + duration,)
 
 if __name__ == '__main__':
     import os, sys
@@ -448,6 +926,188 @@ if __name__ == '__main__':
                 self.assertIn(unicode(value), self.rendered)
                 self.assertIn(unicode(display_value), self.rendered)
 
+    class SplitDateTimeDecompressTest(SimpleTestCase):
+
+        def setUp(self):
+            SplitDateTimeSelectWidget.memo.clear()
+
+        def uncached(self, value):
+            if not timezone.is_aware(value):
+                value = pytz.utc.localize(value)
+            value = timezone.localtime(value)
+            return (value.month, value.day, value.year,
+                time_forms.to_12_hr(value.hour), value.minute // 5 * 5,
+                value.strftime('%p').lower(),)
+
+        def test_matches_uncached(self):
+            widget = SplitDateTimeSelectWidget()
+            start = datetime.datetime(2013, 11, 2, 20)
+            for name in ('America/New_York', 'Asia/Kathmandu', 'UTC',):
+                with timezone.override(pytz.timezone(name)):
+                    for minute in xrange(0, 2 * 24 * 60, 2):
+                        naive = start + datetime.timedelta(minutes=minute,
+                            seconds=minute % 60)
+                        for value in (naive, pytz.utc.localize(naive),):
+                            self.assertEqual(widget.decompress(value),
+                                self.uncached(value), (name, value))
+            self.assertTrue(SplitDateTimeSelectWidget.memo.hit_rate > 0.5)
+
+        def test_shared_results(self):
+            value = pytz.utc.localize(datetime.datetime(2013, 3, 1, 14, 1))
+            with timezone.override(pytz.timezone('America/New_York')):
+                first = SplitDateTimeSelectWidget().decompress(value)
+                self.assertEqual(first, (3, 1, 2013, 9, 0, 'am',))
+                self.assertTrue(SplitDateTimeSelectWidget().decompress(
+                    value.replace(minute=4)) is first)
+            self.assertEqual(SplitDateTimeSelectWidget.memo.hits, 1)
+
+    class BulkInitialTest(SimpleTestCase):
+
+        class Instance(object):
+
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+        def setUp(self):
+            start = pytz.utc.localize(datetime.datetime(2013, 3, 9, 20))
+            self.instances = []
+            for i in xrange(50):
+                self.instances.append(self.Instance(
+                    start=start + datetime.timedelta(hours=i % 10),
+                    end=None if i % 3 else start,
+                    at=datetime.time(i % 24, 5), note='unused'))
+
+        def expected(self):
+            stamp_set = TimeStampSet()
+            initials = []
+            for instance in self.instances:
+                kwargs = {'instance': instance}
+                stamp_set._set_datetime_on(['start', 'end'], kwargs)
+                stamp_set._set_time_on(['at'], kwargs)
+                initials.append(kwargs['initial'])
+            return initials
+
+        def test_instances(self):
+            with timezone.override(pytz.timezone('America/New_York')):
+                initials = TimeStampSet._bulk_initial(self.instances,
+                    ['start', 'end'], ['at'])
+                self.assertEqual(initials, self.expected())
+            self.assertEqual(initials[0]['start'].tzinfo.zone,
+                'America/New_York')
+            self.assertNotIn('end', initials[1])
+
+        def test_shared_conversions(self):
+            initials = TimeStampSet._bulk_initial(self.instances, ['start'])
+            self.assertTrue(initials[0]['start'] is initials[10]['start'])
+            self.assertEqual(TimeStampSet._bulk_initial([], ['start']), [])
+
+    class TimeStampModelFormSetTest(SimpleTestCase):
+
+        # a model formset on the sqlite test database
+
+        @classmethod
+        def setUpClass(cls):
+            from django.db import connection, models
+            from django.core.management.color import no_style
+
+            class Slot(models.Model):
+
+                start = models.DateTimeField()
+                end = models.DateTimeField(null=True)
+                at = models.TimeField()
+
+                class Meta:
+                    app_label = 'datetime_forms'
+
+            cls.Slot = Slot
+            cls.old_name = connection.creation.create_test_db(verbosity=0)
+            if hasattr(connection, 'schema_editor'):
+                with connection.schema_editor() as editor:
+                    editor.create_model(Slot)
+            else:
+                cursor = connection.cursor()
+                for statement in connection.creation.sql_create_model(Slot,
+                        no_style())[0]:
+                    cursor.execute(statement)
+            start = pytz.utc.localize(datetime.datetime(2013, 3, 9, 20))
+            Slot.objects.bulk_create([
+                Slot(start=start + datetime.timedelta(hours=i % 10),
+                    end=None if i % 3 else start, at=datetime.time(i % 24, 5))
+                for i in xrange(30)])
+
+        @classmethod
+        def tearDownClass(cls):
+            from django.db import connection
+            connection.creation.destroy_test_db(cls.old_name, verbosity=0)
+
+        def get_formset_class(self):
+            from django.forms.models import modelformset_factory
+
+            class SlotFormSet(TimeStampModelFormSet):
+                datetime_fields = ('start', 'end',)
+                time_fields = ('at',)
+
+            return modelformset_factory(self.Slot, formset=SlotFormSet,
+                extra=1, fields=('start', 'end', 'at',))
+
+        def expected(self, instance):
+            kwargs = {'instance': instance}
+            stamp_set = TimeStampSet()
+            stamp_set._set_datetime_on(['start', 'end'], kwargs)
+            stamp_set._set_time_on(['at'], kwargs)
+            return kwargs['initial']
+
+        def test_initial(self):
+            from django.db import connection
+            from django.test.utils import CaptureQueriesContext
+
+            FormSet = self.get_formset_class()
+            tz = pytz.timezone('America/New_York')
+            with timezone.override(tz):
+                with CaptureQueriesContext(connection) as queries:
+                    formset = FormSet(queryset=self.Slot.objects.all())
+                    forms = formset.forms
+                # no query besides the formset's own
+                self.assertEqual(len(queries), 1)
+                self.assertEqual(len(forms), 31)
+                for form in forms[:-1]:
+                    for name, value in self.expected(form.instance).items():
+                        self.assertEqual(form.initial[name], value)
+                    self.assertEqual(form.initial['start'].tzinfo.zone,
+                        tz.zone)
+                self.assertEqual(forms[-1].initial, {})
+
+        def test_bound(self):
+            # posted rows find their conversions by primary key
+            FormSet = self.get_formset_class()
+            queryset = self.Slot.objects.order_by('-pk')
+            formset = FormSet(queryset=queryset)
+            data = {'form-TOTAL_FORMS': '2', 'form-INITIAL_FORMS': '2',
+                'form-MAX_NUM_FORMS': '',}
+            for i, form in enumerate(formset.forms[:2]):
+                data['form-{0}-id'.format(i)] = str(form.instance.pk)
+            formset = FormSet(data, queryset=self.Slot.objects.order_by('pk'))
+            for i, form in enumerate(formset.forms):
+                self.assertEqual(str(form.instance.pk),
+                    data['form-{0}-id'.format(i)])
+                self.assertEqual(form.initial['start'],
+                    self.expected(form.instance)['start'])
+
+        def test_bulk_initial_queryset(self):
+            # an unevaluated queryset only fetches the columns asked for
+            from django.db import connection
+            from django.test.utils import CaptureQueriesContext
+
+            queryset = self.Slot.objects.order_by('pk')
+            with timezone.override(pytz.timezone('Asia/Tokyo')):
+                with CaptureQueriesContext(connection) as queries:
+                    initials = TimeStampSet._bulk_initial(queryset,
+                        ['start', 'end'], ['at'])
+                self.assertEqual(initials, [self.expected(instance)
+                    for instance in queryset])
+            self.assertEqual(len(queries), 1)
+            self.assertNotIn('"id"', queries[0]['sql'].split(' FROM ')[0])
+
     class SplitDateTimeFieldTest(SimpleTestCase):
 
         def test_create(self):
@@ -486,4 +1146,324 @@ if __name__ == '__main__':
             self.assertIn(minute_assert, html_output)
             self.assertIn(ampm_assert, html_output)
 
+    class FindIntervalConflictsTest(SimpleTestCase):
+
+        def setUp(self):
+            self.base = datetime.datetime(2013, 3, 1, 9)
+
+        def at(self, minutes, length):
+            start = self.base + datetime.timedelta(minutes=minutes)
+            return (start, start + datetime.timedelta(minutes=length))
+
+        def test_no_conflicts(self):
+            intervals = [self.at(0, 30), self.at(30, 30), self.at(60, 5)]
+            self.assertEqual(find_interval_conflicts(intervals), ([], []))
+
+        def test_overlaps_and_duplicates(self):
+            intervals = [self.at(60, 30), self.at(0, 90), self.at(120, 15),
+                self.at(120, 15), self.at(200, 0)]
+            overlaps, duplicates = find_interval_conflicts(intervals)
+            self.assertEqual(overlaps, [(0, 1)])
+            self.assertEqual(duplicates, [(2, 3)])
+
+        def test_repeated_duplicates(self):
+            intervals = [self.at(0, 30)] * 3 + [self.at(15, 30)]
+            overlaps, duplicates = find_interval_conflicts(intervals)
+            self.assertEqual(duplicates, [(0, 1, 2,)])
+            self.assertEqual(overlaps, [(0, 3), (1, 3), (2, 3)])
+
+        def test_many_duplicates(self):
+            # identical rows share one heap entry instead of being rescanned
+            intervals = [self.at(0, 30)] * 20000 + [self.at(20, 30)] * 2
+            overlaps, duplicates = find_interval_conflicts(intervals)
+            self.assertEqual(duplicates, [tuple(xrange(20000)), (20000, 20001)])
+            self.assertEqual(len(overlaps), 40000)
+
+    class ScheduleFormSetTest(SimpleTestCase):
+
+        class SlotForm(DurationForm):
+            start = SplitDateTimeField()
+
+        def get_data(self, rows):
+            data = {
+                'form-TOTAL_FORMS': str(len(rows)),
+                'form-INITIAL_FORMS': '0',
+                'form-MAX_NUM_FORMS': '',}
+            for i, row in enumerate(rows):
+                for j, value in enumerate(row[:6]):
+                    data['form-{0}-start_{1}'.format(i, j)] = value
+                data['form-{0}-time_amount'.format(i)] = row[6]
+                data['form-{0}-time_metric'.format(i)] = row[7]
+            return data
+
+        def get_formset(self, rows):
+            FormSet = django_forms.formsets.formset_factory(self.SlotForm,
+                formset=ScheduleFormSet, extra=0)
+            return FormSet(self.get_data(rows))
+
+        def test_valid_schedule(self):
+            formset = self.get_formset([
+                ['3', '1', '2013', '9', '0', 'am', '30', 'min'],
+                ['3', '1', '2013', '9', '30', 'am', '1', 'hour'],])
+            self.assertTrue(formset.is_valid())
+            self.assertEqual(formset.conflicts, [])
+
+        def test_conflicting_rows_get_errors(self):
+            formset = self.get_formset([
+                ['3', '1', '2013', '9', '0', 'am', '1', 'hour'],
+                ['3', '1', '2013', '9', '30', 'am', '30', 'min'],
+                ['3', '1', '2013', '11', '0', 'am', '15', 'min'],
+                ['3', '1', '2013', '11', '0', 'am', '15', 'min'],
+                ['3', '1', '2013', '1', '0', 'pm', '15', 'min'],])
+            self.assertFalse(formset.is_valid())
+            self.assertIn('Conflicting time slots', formset.non_form_errors())
+            self.assertEqual(formset.errors[0]['start'],
+                [ScheduleFormSet.overlap_message])
+            self.assertEqual(formset.errors[1]['start'],
+                [ScheduleFormSet.overlap_message])
+            self.assertEqual(formset.errors[2]['start'],
+                [ScheduleFormSet.duplicate_message])
+            self.assertEqual(formset.errors[3]['start'],
+                [ScheduleFormSet.duplicate_message])
+            self.assertEqual(formset.errors[4], {})
+            self.assertIn((ScheduleFormSet.duplicate_message, 'form-2',
+                'form-3',), formset.conflicts)
+
+    class DurationFormTest(SimpleTestCase):
+
+        def test_time_delta(self):
+            form = DurationForm({'time_amount': '90', 'time_metric': 'min'})
+            self.assertTrue(form.is_valid())
+            self.assertEqual(form.cleaned_data['time_delta'],
+                datetime.timedelta(minutes=90))
+            form = DurationForm({'time_amount': '2', 'time_metric': 'hour'})
+            self.assertTrue(form.is_valid())
+            self.assertEqual(form.cleaned_data['time_delta'],
+                datetime.timedelta(hours=2))
+
+        def test_time_delta_partial(self):
+            form = DurationForm({'time_amount': '', 'time_metric': 'hour'})
+            self.assertFalse(form.is_valid())
+            self.assertEqual(form.cleaned_data['time_delta'], None)
+            form = DurationForm({'time_amount': '30', 'time_metric': ''})
+            self.assertFalse(form.is_valid())
+            self.assertIn('time_metric', form.errors)
+            self.assertEqual(form.cleaned_data['time_delta'], None)
+            form = DurationForm({'time_amount': '', 'time_metric': ''})
+            self.assertTrue(form.is_valid())
+            self.assertEqual(form.cleaned_data['time_delta'], None)
+
+    class AggregateDurationsTest(SimpleTestCase):
+
+        def get_forms(self):
+            forms = []
+            for amount, metric in (('30', 'min'), ('1', 'hour'),
+                    ('45', 'min'), ('2', 'hour'),):
+                form = DurationForm({'time_amount': amount,
+                    'time_metric': metric})
+                form.is_valid()
+                forms.append(form)
+            return forms
+
+        def check(self, result):
+            self.assertEqual(result['count'], 4)
+            self.assertEqual(result['total'],
+                datetime.timedelta(minutes=255))
+            self.assertEqual(result['per_metric']['min']['amount'], 75)
+            self.assertEqual(result['per_metric']['hour']['count'], 2)
+            self.assertEqual(result['per_metric']['hour']['total'],
+                datetime.timedelta(hours=3))
+            self.assertEqual(result['distribution']['min'],
+                datetime.timedelta(minutes=30))
+            self.assertEqual(result['distribution']['max'],
+                datetime.timedelta(hours=2))
+            self.assertEqual(result['distribution']['median'],
+                datetime.timedelta(minutes=52, seconds=30))
+
+        def test_aggregate(self):
+            self.check(aggregate_durations(self.get_forms()))
+
+        def test_aggregate_without_numpy(self):
+            global _numpy
+            saved, _numpy = _numpy, None
+            try:
+                self.check(aggregate_durations(self.get_forms()))
+            finally:
+                _numpy = saved
+
+        def test_numpy_matches_python(self):
+            global _numpy
+            forms = []
+            for i in xrange(101):
+                form = DurationForm({'time_amount': str(1 + i * 7 % 50),
+                    'time_metric': ('min', 'hour',)[i % 3 == 0]})
+                form.is_valid()
+                forms.append(form)
+            # odd and even counts, for both medians
+            for rows in (forms, forms[:-1],):
+                saved, _numpy = _numpy, None
+                try:
+                    expected = aggregate_durations(rows)
+                finally:
+                    _numpy = saved
+                self.assertEqual(aggregate_durations(rows), expected)
+
+        def test_aggregate_empty(self):
+            result = aggregate_durations([])
+            self.assertEqual(result['count'], 0)
+            self.assertEqual(result['total'], datetime.timedelta(0))
+            self.assertEqual(result['distribution'], None)
+
+    class IterRecurrencesTest(SimpleTestCase):
+
+        def setUp(self):
+            self.tz = pytz.timezone('America/New_York')
+            self.start = self.tz.localize(datetime.datetime(2013, 3, 8, 9))
+
+        def test_count_and_duration(self):
+            occurrences = list(iter_recurrences(self.start,
+                datetime.timedelta(minutes=30), rule='weekly', count=3,
+                tz=self.tz))
+            self.assertEqual(len(occurrences), 3)
+            self.assertEqual(occurrences[2][0].date(),
+                datetime.date(2013, 3, 22))
+            self.assertEqual(occurrences[2][1] - occurrences[2][0],
+                datetime.timedelta(minutes=30))
+
+        def test_keeps_local_time_across_dst(self):
+            occurrences = list(iter_recurrences(self.start, count=3,
+                tz=self.tz))
+            for occurrence, end in occurrences:
+                self.assertEqual(occurrence.hour, 9)
+            self.assertEqual(occurrences[2][0] - occurrences[1][0],
+                datetime.timedelta(hours=23))
+
+        def test_duration_form(self):
+            form = DurationForm({'time_amount': '2', 'time_metric': 'hour'})
+            form.is_valid()
+            occurrence, end = next(iter_recurrences(self.start, form,
+                tz=self.tz))
+            self.assertEqual(end - occurrence, datetime.timedelta(hours=2))
+
+        def test_window_is_lazy_and_unbounded(self):
+            window = (self.tz.localize(datetime.datetime(2014, 6, 1)),
+                self.tz.localize(datetime.datetime(2014, 6, 8)))
+            occurrences = iter_recurrences(self.start, window=window,
+                tz=self.tz)
+            occurrences = list(occurrences)
+            self.assertEqual(len(occurrences), 7)
+            self.assertEqual(occurrences[0][0],
+                self.tz.localize(datetime.datetime(2014, 6, 1, 9)))
+
+        def test_until(self):
+            until = self.start + datetime.timedelta(days=2)
+            self.assertEqual(len(list(iter_recurrences(self.start,
+                until=until, tz=self.tz))), 3)
+
+        def test_unknown_rule(self):
+            self.assertRaises(ValueError, iter_recurrences, self.start,
+                rule='hourly')
+
+        def test_interval(self):
+            for interval in (0, -1):
+                self.assertRaises(ValueError, iter_recurrences, self.start,
+                    interval=interval)
+                self.assertRaises(ValueError, iter_recurrences, self.start,
+                    interval=interval, window=(self.start, None))
+            occurrences = list(iter_recurrences(self.start, count=2,
+                interval=3, rule='weekly', tz=self.tz))
+            self.assertEqual(occurrences[1][0],
+                self.tz.localize(datetime.datetime(2013, 3, 29, 9)))
+
+    class NativeDateFieldTest(SimpleTestCase):
+
+        def test_clean(self):
+            field = NativeDateField()
+            year = timezone.now().year
+            self.assertEqual(field.clean('{0}-02-28'.format(year)),
+                datetime.date(year, 2, 28))
+            self.assertEqual(field.clean(datetime.date(year, 3, 1)),
+                datetime.date(year, 3, 1))
+
+        def test_clean_invalid(self):
+            field = NativeDateField()
+            for value in ('2013-02-30', '2013/02/01', '02-01-2013', '1899-01-01',
+                    ''):
+                self.assertRaises(django_forms.ValidationError, field.clean,
+                    value)
+            self.assertEqual(NativeDateField(all_years=True).clean(
+                '1899-01-01'), datetime.date(1899, 1, 1))
+
+        def test_layout_before_parser(self):
+            # forms newer fromisoformat versions take are rejected first
+            global _date_from_iso
+            saved = _date_from_iso
+            for parser in (saved, lambda value: datetime.date(2013, 3, 1),):
+                _date_from_iso = parser
+                try:
+                    for value in ('20130301', '2013-W09-5', '2013-060',
+                            '2013-03-01T00:00', u'\u0662013-03-01'):
+                        self.assertRaises(ValueError, parse_iso_date, value)
+                finally:
+                    _date_from_iso = saved
+
+        def test_render(self):
+            rendered = NativeDateInput().render('day', datetime.date(2013, 3, 1))
+            self.assertIn('type="date"', rendered)
+            self.assertIn('value="2013-03-01"', rendered)
+
+    class NativeDateTimeFieldTest(SimpleTestCase):
+
+        def test_clean_matches_split_field(self):
+            year = timezone.now().year
+            native = NativeDateTimeField()
+            split = SplitDateTimeField()
+            for tz in ('UTC', 'America/New_York', 'Asia/Tokyo',):
+                with timezone.override(pytz.timezone(tz)):
+                    value = native.clean('{0}-03-01T21:05'.format(year))
+                    self.assertEqual(value, split.clean(
+                        ['3', '1', str(year), '9', '5', 'pm']))
+                    self.assertEqual(value.utcoffset(),
+                        pytz.timezone(tz).localize(value.replace(
+                            tzinfo=None)).utcoffset())
+
+        def test_clean_invalid(self):
+            field = NativeDateTimeField()
+            for value in ('2013-03-01T21:07', '2013-03-01', '2013-03-01T25:00',
+                    '2013-03-01T21:05+01:00', ''):
+                self.assertRaises(django_forms.ValidationError, field.clean,
+                    value)
+
+        def test_layout_before_parser(self):
+            # a date alone is midnight to newer fromisoformat versions
+            global _datetime_from_iso
+            saved = _datetime_from_iso
+            for parser in (saved,
+                    lambda value: datetime.datetime(2013, 3, 1),):
+                _datetime_from_iso = parser
+                try:
+                    for value in ('2013-03-01', '2013-03-01T21', '20130301T2105',
+                            '2013-03-01T21:05:00.000', '2013-03-01T21:05Z',
+                            '2013-03-01X21:05'):
+                        self.assertRaises(ValueError, parse_iso_datetime,
+                            value)
+                    self.assertRaises(django_forms.ValidationError,
+                        NativeDateTimeField().clean, '2013-03-01')
+                finally:
+                    _datetime_from_iso = saved
+            self.assertEqual(parse_iso_datetime('2013-03-01 21:05:30'),
+                datetime.datetime(2013, 3, 1, 21, 5, 30))
+
+        def test_render(self):
+            value = pytz.utc.localize(datetime.datetime(2013, 3, 1, 14, 43))
+            with timezone.override(pytz.timezone('America/New_York')):
+                rendered = NativeDateTimeInput().render('start', value)
+            self.assertIn('type="datetime-local"', rendered)
+            self.assertIn('value="2013-03-01T09:40"', rendered)
+            # naive values are utc
+            with timezone.override(pytz.utc):
+                rendered = NativeDateTimeInput().render('start',
+                    value.replace(tzinfo=None))
+            self.assertIn('value="2013-03-01T14:40"', rendered)
+
     unittest.main()
@@ -0,0 +1,272 @@
+import datetime
+
+from django.utils import timezone
+from django import forms as django_forms
+
+import time_forms
+import datetime_forms
+
+# Filters built from split date/time fields as half-open ranges on the raw
+# datetime column, [start, end), so the database can use a b-tree index
+# instead of evaluating __date/__year on every row.
+
+def _local_midnight(date, tz):
+    return datetime_forms._localize(
+        datetime.datetime.combine(date, datetime.time()), tz)
+
+def date_bounds(date_from, date_to=None, tz=None):
+    # whole local days from date_from through date_to inclusive
+    if tz is None:
+        tz = timezone.get_current_timezone()
+    if date_to is None:
+        date_to = date_from
+    return (_local_midnight(date_from, tz),
+        _local_midnight(date_to + datetime.timedelta(days=1), tz),)
+
+def year_bounds(year, tz=None):
+    return date_bounds(datetime.date(year, 1, 1),
+        datetime.date(year, 12, 31), tz)
+
+def time_of_day_bounds(date_from, date_to=None, time_from=None,
+        time_to=None, tz=None):
+    # one range per local day; time_to at or before time_from runs into
+    # the next day
+    if tz is None:
+        tz = timezone.get_current_timezone()
+    if date_to is None:
+        date_to = date_from
+    if time_from is None:
+        time_from = datetime.time()
+    if time_to is None:
+        time_to = datetime.time()
+
+    bounds = []
+    day = date_from
+    while day <= date_to:
+        end_day = day
+        if time_to <= time_from:
+            end_day = day + datetime.timedelta(days=1)
+        bounds.append((
+            datetime_forms._localize(
+                datetime.datetime.combine(day, time_from), tz),
+            datetime_forms._localize(
+                datetime.datetime.combine(end_day, time_to), tz),))
+        day += datetime.timedelta(days=1)
+    return bounds
+
+def range_lookups(column, start, end):
+    return {
+        '{0}__gte'.format(column): start,
+        '{0}__lt'.format(column): end,}
+
+def range_q(column, bounds):
+    from django.db.models import Q
+    q = None
+    for start, end in bounds:
+        range_ = Q(**range_lookups(column, start, end))
+        q = range_ if q is None else q | range_
+    return q
+
+class RangeFilterMixin(object):
+
+    # mix into a form with SplitDateField/SplitTimeField members named by
+    # the *_field attributes; set filter_column to the model's datetime
+    # column
+    filter_column = None
+    date_from_field = 'date_from'
+    date_to_field = 'date_to'
+    time_from_field = 'time_from'
+    time_to_field = 'time_to'
+
+    def clean(self):
+        cleaned_data = super(RangeFilterMixin, self).clean()
+        date_from = cleaned_data.get(self.date_from_field, None)
+        date_to = cleaned_data.get(self.date_to_field, None)
+        if date_from and date_to and date_to < date_from:
+            msg = 'End date is before start date'
+            self._errors[self.date_to_field] = self.error_class([msg])
+            del cleaned_data[self.date_to_field]
+        return cleaned_data
+
+    def get_bounds(self, tz=None):
+        cleaned_data = self.cleaned_data
+        date_from = cleaned_data[self.date_from_field]
+        date_to = cleaned_data.get(self.date_to_field, None)
+        time_from = cleaned_data.get(self.time_from_field, None)
+        time_to = cleaned_data.get(self.time_to_field, None)
+        if time_from is None and time_to is None:
+            return [date_bounds(date_from, date_to, tz)]
+        return time_of_day_bounds(date_from, date_to, time_from, time_to,
+            tz)
+
+    def get_q(self, column=None, tz=None):
+        return range_q(column or self.filter_column, self.get_bounds(tz))
+
+    def filter_queryset(self, queryset, column=None, tz=None):
+        return queryset.filter(self.get_q(column, tz))
+
+if __name__ == '__main__':
+    import os, sys
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'tests',
+        'django_more_forms_tests',))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_more_forms_tests.settings'
+
+    import unittest
+    import pytz
+    from django.test import SimpleTestCase
+
+    class BoundsTest(SimpleTestCase):
+
+        def setUp(self):
+            self.tz = pytz.timezone('America/New_York')
+
+        def test_date_bounds(self):
+            start, end = date_bounds(datetime.date(2013, 3, 10), tz=self.tz)
+            self.assertEqual(start.astimezone(pytz.utc),
+                pytz.utc.localize(datetime.datetime(2013, 3, 10, 5)))
+            # dst starts, the local day is 23 hours long
+            self.assertEqual(end - start, datetime.timedelta(hours=23))
+
+        def test_year_bounds(self):
+            start, end = year_bounds(2013, self.tz)
+            self.assertEqual(start,
+                self.tz.localize(datetime.datetime(2013, 1, 1)))
+            self.assertEqual(end,
+                self.tz.localize(datetime.datetime(2014, 1, 1)))
+
+        def test_time_of_day_bounds(self):
+            bounds = time_of_day_bounds(datetime.date(2013, 3, 1),
+                datetime.date(2013, 3, 3), datetime.time(22),
+                datetime.time(2), self.tz)
+            self.assertEqual(len(bounds), 3)
+            self.assertEqual(bounds[0][1] - bounds[0][0],
+                datetime.timedelta(hours=4))
+
+        def test_range_q(self):
+            from django.db.models import Q
+            q = range_q('created', [(1, 2), (3, 4)])
+            self.assertEqual(q.connector, Q.OR)
+            self.assertEqual(len(q.children), 2)
+
+    class DateRangeFilterForm(RangeFilterMixin, django_forms.Form):
+
+        date_from = datetime_forms.SplitDateField()
+        date_to = datetime_forms.SplitDateField(required=False)
+        time_from = time_forms.SplitTimeField(required=False)
+        time_to = time_forms.SplitTimeField(required=False)
+
+    class RangeFilterMixinTest(SimpleTestCase):
+
+        def get_form(self, **data):
+            defaults = {
+                'date_from_0': '3', 'date_from_1': '1',
+                'date_from_2': '2013',}
+            defaults.update(data)
+            return DateRangeFilterForm(defaults)
+
+        def test_single_day(self):
+            form = self.get_form()
+            self.assertTrue(form.is_valid())
+            bounds = form.get_bounds()
+            self.assertEqual(len(bounds), 1)
+            self.assertEqual(bounds[0][1] - bounds[0][0],
+                datetime.timedelta(days=1))
+
+        def test_time_of_day(self):
+            form = self.get_form(date_to_0='3', date_to_1='2',
+                date_to_2='2013', time_from_0='9', time_from_1='0',
+                time_from_2='am', time_to_0='5', time_to_1='0',
+                time_to_2='pm')
+            self.assertTrue(form.is_valid())
+            q = form.get_q('created')
+            self.assertEqual(len(q.children), 2)
+
+        def test_reversed_dates(self):
+            form = self.get_form(date_to_0='2', date_to_1='1',
+                date_to_2='2013')
+            self.assertFalse(form.is_valid())
+
+    class QueryPlanTest(SimpleTestCase):
+
+        # the sql django generates from filter_queryset, explained by sqlite
+
+        @classmethod
+        def setUpClass(cls):
+            from django.db import connection, models
+            from django.core.management.color import no_style
+
+            class Event(models.Model):
+
+                created = models.DateTimeField(db_index=True)
+
+                class Meta:
+                    app_label = 'filter_forms'
+
+            cls.Event = Event
+            cls.old_name = connection.creation.create_test_db(verbosity=0)
+            cursor = connection.cursor()
+            if hasattr(connection, 'schema_editor'):
+                with connection.schema_editor() as editor:
+                    editor.create_model(Event)
+            else:
+                style = no_style()
+                statements = connection.creation.sql_create_model(Event,
+                    style)[0]
+                statements += connection.creation.sql_indexes_for_model(
+                    Event, style)
+                for statement in statements:
+                    cursor.execute(statement)
+            start = pytz.utc.localize(datetime.datetime(2013, 2, 27))
+            Event.objects.bulk_create([
+                Event(created=start + datetime.timedelta(hours=i))
+                for i in xrange(24 * 5)])
+
+        @classmethod
+        def tearDownClass(cls):
+            from django.db import connection
+            connection.creation.destroy_test_db(cls.old_name, verbosity=0)
+
+        def plan(self, queryset):
+            from django.db import connection
+            sql, params = queryset.query.sql_with_params()
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+        def get_form(self, **data):
+            data.update({'date_from_0': '3', 'date_from_1': '1',
+                'date_from_2': '2013',})
+            form = DateRangeFilterForm(data)
+            self.assertTrue(form.is_valid(), form.errors)
+            return form
+
+        def test_date_range_uses_index(self):
+            with timezone.override(pytz.timezone('America/New_York')):
+                queryset = self.get_form().filter_queryset(
+                    self.Event.objects.all(), 'created')
+            plan = self.plan(queryset)
+            self.assertIn('SEARCH', plan, plan)
+            self.assertIn('INDEX', plan, plan)
+            self.assertEqual(queryset.count(), 24)
+
+        def test_time_of_day_ranges_use_index(self):
+            form = self.get_form(date_to_0='3', date_to_1='2',
+                date_to_2='2013', time_from_0='9', time_from_1='0',
+                time_from_2='am', time_to_0='5', time_to_1='0',
+                time_to_2='pm')
+            with timezone.override(pytz.timezone('America/New_York')):
+                queryset = form.filter_queryset(self.Event.objects.all(),
+                    'created')
+            plan = self.plan(queryset)
+            self.assertIn('INDEX', plan, plan)
+            self.assertNotIn('SCAN', plan, plan)
+            self.assertEqual(queryset.count(), 16)
+
+        def test_date_function_scans(self):
+            plan = self.plan(self.Event.objects.extra(
+                where=['date(created) = %s'], params=['2013-03-01']))
+            self.assertNotIn('SEARCH', plan, plan)
+
+    unittest.main()
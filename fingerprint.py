@@ -0,0 +1,243 @@
+import hashlib
+
+from django.utils import timezone
+from django.utils import translation
+from django.utils.http import parse_etags, quote_etag
+from django.forms.formsets import BaseFormSet
+
+import time_forms
+import datetime_forms
+import form_tables
+
+# Deterministic fingerprints of unbound forms and formsets, usable as
+# ETags: the same initial values, choice tables, locale and time zone
+# always render the same html.
+
+# (key, digest) pair, replaced as a whole so threads never lock to read it
+_choice_version = (None, None,)
+
+def choice_tables_version():
+    # the years table changes with the calendar year and mapped tables can
+    # be swapped at startup, so the digest is cached on both
+    global _choice_version
+    key = (timezone.now().year, form_tables.load_count,)
+    cached_key, version = _choice_version
+    if cached_key == key:
+        return version
+    digest = hashlib.sha1()
+    for choices in (
+            datetime_forms.DateOptionChoices.months(),
+            datetime_forms.DateOptionChoices.days(),
+            datetime_forms.DateOptionChoices.years(),
+            time_forms.TimeOptionChoices.hours(),
+            time_forms.TimeOptionChoices.minutes(),
+            time_forms.TimeOptionChoices.ampm(),):
+        digest.update(repr(list(choices)).encode('utf-8'))
+    version = digest.hexdigest()
+    _choice_version = (key, version,)
+    return version
+
+def _initial_value(form, name, field):
+    value = form.initial.get(name, field.initial)
+    if callable(value):
+        value = value()
+    decompress = getattr(field.widget, 'decompress', None)
+    if decompress is not None and value and \
+            not isinstance(value, (list, tuple,)):
+        value = decompress(value)
+    return value
+
+def _update_form(digest, form):
+    digest.update(repr((form.__class__.__module__,
+        form.__class__.__name__, form.prefix,)).encode('utf-8'))
+    for name, field in form.fields.items():
+        digest.update(repr((name, field.__class__.__name__,
+            _initial_value(form, name, field),)).encode('utf-8'))
+
+def form_fingerprint(form, key=None):
+    # None for bound forms, their html depends on the submitted data; key
+    # covers whatever else the page shows (user, template version, ...)
+    if form.is_bound:
+        return None
+    digest = hashlib.sha1()
+    digest.update(repr((choice_tables_version(),
+        translation.get_language(),
+        timezone.get_current_timezone_name(),
+        key,)).encode('utf-8'))
+    if isinstance(form, BaseFormSet):
+        _update_form(digest, form.management_form)
+        for subform in form.forms:
+            _update_form(digest, subform)
+    else:
+        _update_form(digest, form)
+    return digest.hexdigest()
+
+def conditional_form_response(request, form, render, key=None):
+    # render is called only when the client's copy is stale. The csrf
+    # token rendered into the form is part of the ETag so a rotated token
+    # (e.g. after login) never gets a 304; pass key for the rest of the
+    # page, such as the user id and template version.
+    from django.http import HttpResponseNotModified
+    from django.utils.cache import patch_vary_headers
+
+    etag = form_fingerprint(form,
+        (key, request.META.get('CSRF_COOKIE', None),))
+    if etag is None:
+        return render()
+    if request.method in ('GET', 'HEAD',):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match and etag in parse_etags(if_none_match):
+            response = HttpResponseNotModified()
+            response['ETag'] = quote_etag(etag)
+            patch_vary_headers(response, ('Cookie',))
+            return response
+    response = render()
+    response['ETag'] = quote_etag(etag)
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+if __name__ == '__main__':
+    import os, sys
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'tests',
+        'django_more_forms_tests',))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_more_forms_tests.settings'
+
+    import datetime
+    import unittest
+    import pytz
+    from django import forms as django_forms
+    from django.http import HttpResponse
+    from django.test import SimpleTestCase
+    from django.test.client import RequestFactory
+
+    class EventForm(django_forms.Form):
+
+        start = datetime_forms.SplitDateTimeField()
+        at = time_forms.SplitTimeField()
+
+    class FormFingerprintTest(SimpleTestCase):
+
+        def setUp(self):
+            self.start = pytz.utc.localize(datetime.datetime(2013, 3, 1, 14))
+            self.initial = {'start': self.start, 'at': datetime.time(9, 5)}
+
+        def test_stable(self):
+            self.assertEqual(
+                form_fingerprint(EventForm(initial=self.initial)),
+                form_fingerprint(EventForm(initial=dict(self.initial))))
+
+        def test_initial_changes(self):
+            other = dict(self.initial, at=datetime.time(9, 10))
+            self.assertNotEqual(
+                form_fingerprint(EventForm(initial=self.initial)),
+                form_fingerprint(EventForm(initial=other)))
+
+        def test_same_slot(self):
+            # values rendering into the same selects share a fingerprint
+            other = dict(self.initial, at=datetime.time(9, 6))
+            self.assertEqual(
+                form_fingerprint(EventForm(initial=self.initial)),
+                form_fingerprint(EventForm(initial=other)))
+
+        def test_time_zone_changes(self):
+            fingerprint = form_fingerprint(EventForm(initial=self.initial))
+            with timezone.override(pytz.timezone('Europe/Paris')):
+                self.assertNotEqual(fingerprint,
+                    form_fingerprint(EventForm(initial=self.initial)))
+
+        def test_formset(self):
+            FormSet = django_forms.formsets.formset_factory(EventForm)
+            self.assertEqual(
+                form_fingerprint(FormSet(initial=[self.initial])),
+                form_fingerprint(FormSet(initial=[self.initial])))
+            self.assertNotEqual(
+                form_fingerprint(FormSet(initial=[self.initial])),
+                form_fingerprint(FormSet(initial=[self.initial] * 2)))
+
+        def test_bound(self):
+            self.assertEqual(form_fingerprint(EventForm({})), None)
+
+        def test_reloaded_tables(self):
+            import shutil
+            import tempfile
+
+            directory = tempfile.mkdtemp()
+            path = os.path.join(directory, 'form_tables.bin')
+            unloaded = choice_tables_version()
+            try:
+                tables = form_tables.build_tables(['en-us'])
+                form_tables.write_tables(path, tables)
+                form_tables.load_tables(path)
+                first = choice_tables_version()
+                tables['choices:hours'] = [['', '---'], [1, 'one']]
+                form_tables.write_tables(path, tables)
+                form_tables.unload_tables()
+                form_tables.load_tables(path)
+                self.assertNotEqual(choice_tables_version(), first)
+            finally:
+                form_tables.unload_tables()
+                shutil.rmtree(directory)
+            self.assertEqual(choice_tables_version(), unloaded)
+
+    class ConditionalFormResponseTest(SimpleTestCase):
+
+        def setUp(self):
+            self.factory = RequestFactory()
+            self.rendered = []
+
+        def render(self):
+            self.rendered.append(True)
+            return HttpResponse('form')
+
+        def test_not_modified(self):
+            form = EventForm()
+            response = conditional_form_response(self.factory.get('/'),
+                form, self.render)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+
+            request = self.factory.get('/', HTTP_IF_NONE_MATCH=etag)
+            response = conditional_form_response(request, form, self.render)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(len(self.rendered), 1)
+
+        def test_vary_cookie(self):
+            response = conditional_form_response(self.factory.get('/'),
+                EventForm(), self.render)
+            self.assertEqual(response['Vary'], 'Cookie')
+            request = self.factory.get('/',
+                HTTP_IF_NONE_MATCH=response['ETag'])
+            response = conditional_form_response(request, EventForm(),
+                self.render)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['Vary'], 'Cookie')
+
+        def test_key_changes_etag(self):
+            request = self.factory.get('/')
+            etag = conditional_form_response(request, EventForm(),
+                self.render, key=1)['ETag']
+            request = self.factory.get('/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(conditional_form_response(request, EventForm(),
+                self.render, key=1).status_code, 304)
+            self.assertEqual(conditional_form_response(request, EventForm(),
+                self.render, key=2).status_code, 200)
+
+        def test_rotated_csrf_token(self):
+            request = self.factory.get('/')
+            request.META['CSRF_COOKIE'] = 'before-login'
+            etag = conditional_form_response(request, EventForm(),
+                self.render)['ETag']
+            request = self.factory.get('/', HTTP_IF_NONE_MATCH=etag)
+            request.META['CSRF_COOKIE'] = 'after-login'
+            self.assertEqual(conditional_form_response(request, EventForm(),
+                self.render).status_code, 200)
+
+        def test_stale(self):
+            request = self.factory.get('/', HTTP_IF_NONE_MATCH='"stale"')
+            response = conditional_form_response(request, EventForm(),
+                self.render)
+            self.assertEqual(response.status_code, 200)
+
+    unittest.main()
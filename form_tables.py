@@ -0,0 +1,437 @@
+import os
+import struct
+
+# Precomputed choice tables, option fragments and the 12 hour conversion
+# table, written once by the warm_form_tables command and memory-mapped by
+# every worker, so the pages are shared between processes. The choice
+# classes return the mapped choices, the select widgets render their
+# options from the fragments and TimeMode builds its tables from hours:24.
+#
+# file layout: header (magic, version, index length), json index of
+# {name: [offset, length]}, then the json encoded tables
+
+MAGIC = b'DMFT'
+VERSION = 1
+HEADER = struct.Struct('<4sHI')
+
+CHOICE_TABLES = ('months', 'days', 'years', 'hours', 'minutes', 'ampm',)
+
+SELECTED = u' selected="selected"'
+
+_loaded = None
+
+# bumped by every load and unload, for caches built from the tables
+load_count = 0
+
+def _choice_builders():
+    import time_forms
+    import datetime_forms
+    return {
+        'months': datetime_forms.DateOptionChoices.months,
+        'days': datetime_forms.DateOptionChoices.days,
+        'years': datetime_forms.DateOptionChoices.years,
+        'hours': time_forms.TimeOptionChoices.hours,
+        'minutes': time_forms.TimeOptionChoices.minutes,
+        'ampm': time_forms.TimeOptionChoices.ampm,}
+
+def build_tables(locales):
+    from django.forms import widgets as django_widgets
+    from django.utils import translation
+    import time_forms
+
+    tables = {}
+    builders = _choice_builders()
+    for name in CHOICE_TABLES:
+        tables['choices:{0}'.format(name)] = \
+            [list(choice) for choice in builders[name]()]
+
+    select = django_widgets.Select()
+    for locale in locales:
+        with translation.override(locale):
+            for name in CHOICE_TABLES:
+                tables['fragments:{0}:{1}'.format(locale, name)] = \
+                    select.render_options(builders[name](), [])
+
+    tables['hours:24'] = [
+        [time_forms.to_12_hr(hour), time_forms.get_ampm(hour).lower()]
+        for hour in xrange(24)]
+    return tables
+
+def write_tables(path, tables):
+    import json
+
+    blobs = []
+    index = {}
+    offset = 0
+    for name in sorted(tables):
+        blob = json.dumps(tables[name], separators=(',', ':')).encode('utf-8')
+        index[name] = [offset, len(blob)]
+        blobs.append(blob)
+        offset += len(blob)
+    index = json.dumps(index, separators=(',', ':')).encode('utf-8')
+
+    # write next to the target and rename so running workers never map a
+    # partially written file
+    tmp_path = '{0}.tmp{1}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(index)))
+        f.write(index)
+        for blob in blobs:
+            f.write(blob)
+    os.rename(tmp_path, path)
+    return path
+
+class MappedTables(object):
+
+    def __init__(self, path):
+        # json and mmap are only imported once tables are used, processes
+        # without a tables file never pay for them
+        import json
+        import mmap
+
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_length = \
+            HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            self.buffer.close()
+            raise ValueError('Unsupported form tables file: {0}'.format(path))
+        start = HEADER.size
+        self.index = json.loads(
+            self.buffer[start:start + index_length].decode('utf-8'))
+        self.data_start = start + index_length
+        self.path = path
+        self._decoded = {}
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get(self, name, default=None):
+        # decoded tables are cached per process; the raw pages stay shared
+        try:
+            return self._decoded[name]
+        except KeyError:
+            pass
+        if name not in self.index:
+            return default
+        import json
+
+        offset, length = self.index[name]
+        start = self.data_start + offset
+        value = json.loads(self.buffer[start:start + length].decode('utf-8'))
+        self._decoded[name] = value
+        return value
+
+    def choices(self, name):
+        key = ('choices', name,)
+        try:
+            return self._decoded[key]
+        except KeyError:
+            pass
+        choices = self.get('choices:{0}'.format(name))
+        if choices is not None:
+            choices = tuple(tuple(choice) for choice in choices)
+        self._decoded[key] = choices
+        return choices
+
+    def options(self, name, language, selected):
+        # the option fragment with the selected values marked, cached when
+        # every value is one of the options so posted garbage can't grow it
+        key = ('options', name, language, selected,)
+        try:
+            return self._decoded[key]
+        except KeyError:
+            pass
+        fragment = self.get('fragments:{0}:{1}'.format(language, name))
+        if fragment is None:
+            return None
+        from django.utils.html import conditional_escape
+
+        found = True
+        for value in selected:
+            needle = u'<option value="{0}">'.format(conditional_escape(value))
+            position = fragment.find(needle)
+            if position == -1:
+                found = False
+                continue
+            position += len(needle) - 1
+            fragment = fragment[:position] + SELECTED + fragment[position:]
+        if found:
+            self._decoded[key] = fragment
+        return fragment
+
+    def close(self):
+        self.buffer.close()
+
+def _clear_time_modes():
+    # time modes built before a load or unload hold the old tables
+    import time_forms
+    time_forms.TimeMode._modes.clear()
+
+def load_tables(path):
+    global _loaded, load_count
+    try:
+        tables = MappedTables(path)
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+    _loaded = tables
+    load_count += 1
+    _clear_time_modes()
+    return tables
+
+def load_from_settings():
+    from django.conf import settings
+    path = getattr(settings, 'MORE_FORMS_TABLES_PATH', None)
+    if path:
+        return load_tables(path)
+    return None
+
+def unload_tables():
+    global _loaded, load_count
+    if _loaded is not None:
+        _loaded.close()
+    _loaded = None
+    load_count += 1
+    _clear_time_modes()
+
+def get_table(name, default=None):
+    if _loaded is None:
+        return default
+    return _loaded.get(name, default)
+
+def get_choices(name):
+    # the mapped choice table, a tuple shared by every caller, or None
+    # when nothing is loaded
+    if _loaded is None:
+        return None
+    return _loaded.choices(name)
+
+def render_options(name, choices, extra_choices, selected_choices):
+    # pre-rendered <option> html for a select showing the named choice
+    # table, the same as Select.render_options; None when the select's
+    # choices aren't the mapped table or its locale wasn't written
+    if _loaded is None or extra_choices or \
+            choices is not _loaded.choices(name):
+        return None
+    from django.utils import translation
+    from django.utils.encoding import force_text
+
+    selected = tuple(sorted(set(force_text(value)
+        for value in selected_choices)))
+    return _loaded.options(name, translation.get_language(), selected)
+
+class TableOptionsMixin(object):
+
+    # for Select widgets showing one of CHOICE_TABLES
+
+    table_name = None
+
+    def render_options(self, choices, selected_choices):
+        html = render_options(self.table_name, self.choices, choices,
+            selected_choices)
+        if html is None:
+            return super(TableOptionsMixin, self).render_options(choices,
+                selected_choices)
+        return html
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'tests',
+        'django_more_forms_tests',))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_more_forms_tests.settings'
+
+    import shutil
+    import datetime
+    import tempfile
+    import unittest
+    import django
+    from django.test import SimpleTestCase
+    from django.utils import translation
+
+    import time_forms
+    import datetime_forms
+    # the choice classes read the tables through the imported module
+    import form_tables
+
+    class FormTablesTest(SimpleTestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.path = os.path.join(self.dir, 'form_tables.bin')
+            self.tables = form_tables.build_tables(['en-us'])
+            form_tables.write_tables(self.path, self.tables)
+
+        def tearDown(self):
+            form_tables.unload_tables()
+            time_forms.TimeMode._modes.clear()
+            shutil.rmtree(self.dir)
+
+        def test_roundtrip(self):
+            minutes = time_forms.TimeOptionChoices.minutes()
+            tables = form_tables.load_tables(self.path)
+            self.assertEqual(list(form_tables.get_choices('minutes')), minutes)
+            self.assertEqual(tables.get('hours:24')[13], [1, 'pm'])
+            self.assertIn('<option value="12">12</option>',
+                tables.get('fragments:en-us:hours'))
+
+        def test_choices_use_loaded_tables(self):
+            self.tables['choices:hours'] = [['', '---'], [1, 'one']]
+            form_tables.write_tables(self.path, self.tables)
+            form_tables.load_tables(self.path)
+            self.assertEqual(time_forms.TimeOptionChoices.hours(),
+                (('', '---'), (1, 'one'),))
+            self.assertEqual(datetime_forms.DateOptionChoices.days(),
+                tuple(tuple(choice) for choice in self.tables['choices:days']))
+            # shared, not copied per call
+            self.assertTrue(time_forms.TimeOptionChoices.hours() is
+                time_forms.TimeOptionChoices.hours())
+
+        def test_widgets_render_fragments(self):
+            value = datetime.datetime(2013, 3, 1, 21, 40)
+            expected = [
+                datetime_forms.SplitDateTimeSelectWidget().render('start',
+                    value),
+                time_forms.SplitTimeSelectWidget().render('at', value.time()),
+                time_forms.SplitTimeSelectWidget().render('at', None),
+                time_forms.SplitTimeSelectWidget().render('at',
+                    ['13', '<b>', 'pm']),]
+            form_tables.load_tables(self.path)
+            rendered = [
+                datetime_forms.SplitDateTimeSelectWidget().render('start',
+                    value),
+                time_forms.SplitTimeSelectWidget().render('at', value.time()),
+                time_forms.SplitTimeSelectWidget().render('at', None),
+                time_forms.SplitTimeSelectWidget().render('at',
+                    ['13', '<b>', 'pm']),]
+            self.assertEqual(rendered, expected)
+            self.assertTrue(('options', 'minutes', 'en-us', (u'40',),) in
+                form_tables._loaded._decoded)
+            # posted values that aren't options aren't cached
+            self.assertFalse(('options', 'minutes', 'en-us', (u'<b>',),) in
+                form_tables._loaded._decoded)
+
+        def test_fragments_are_used(self):
+            self.tables['fragments:en-us:ampm'] = \
+                u'<option value="am">mapped</option>'
+            form_tables.write_tables(self.path, self.tables)
+            form_tables.load_tables(self.path)
+            rendered = time_forms.SplitTimeSelectWidget().render('at',
+                datetime.time(9, 5))
+            self.assertIn('<option value="am" selected="selected">mapped',
+                rendered)
+            # other locales and changed choices render the options
+            widget = time_forms.AmPmSelectWidget()
+            with translation.override('fr'):
+                self.assertNotIn('mapped', widget.render('at', 'am'))
+            widget.choices = list(widget.choices)
+            self.assertNotIn('mapped', widget.render('at', 'am'))
+
+        def test_time_mode_uses_hours_table(self):
+            self.tables['hours:24'][13] = [1, 'xm']
+            form_tables.write_tables(self.path, self.tables)
+            # built before the file is mapped, e.g. by a form class
+            stale = time_forms.TimeMode.get(12, 15)
+            form_tables.load_tables(self.path)
+            mode = time_forms.TimeMode.get(12, 15)
+            self.assertTrue(mode is not stale)
+            self.assertEqual(mode.decompress(datetime.time(13, 20)),
+                (1, 15, 'xm',))
+            self.assertEqual(mode.compress(['1', '15', 'xm']),
+                datetime.time(13, 15))
+            form_tables.unload_tables()
+            self.assertEqual(time_forms.TimeMode.get(12, 15).decompress(
+                datetime.time(13, 20)), (1, 15, 'pm',))
+
+        def test_missing_table(self):
+            form_tables.load_tables(self.path)
+            self.assertEqual(form_tables.get_table('fragments:fr:hours'), None)
+
+        def test_nothing_loaded(self):
+            self.assertEqual(form_tables.get_choices('hours'), None)
+
+        def test_bad_file(self):
+            with open(self.path, 'wb') as f:
+                f.write(b'not a table file')
+            self.assertEqual(form_tables.load_tables(self.path), None)
+
+    class WarmFormTablesCommandTest(SimpleTestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.path = os.path.join(self.dir, 'form_tables.bin')
+
+        def tearDown(self):
+            form_tables.unload_tables()
+            shutil.rmtree(self.dir)
+
+        def run_command(self, *argv):
+            # through the installed package, as manage.py would
+            import importlib
+            from StringIO import StringIO
+
+            package_dir = os.path.dirname(os.path.abspath(__file__))
+            sys.path.append(os.path.dirname(package_dir))
+            try:
+                module = importlib.import_module('{0}.management.commands.'
+                    'warm_form_tables'.format(os.path.basename(package_dir)))
+            finally:
+                sys.path.pop()
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                module.Command().run_from_argv(
+                    ['manage.py', 'warm_form_tables'] + list(argv))
+                return sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+
+        def test_writes_tables(self):
+            output = self.run_command('--output', self.path, '--locale',
+                'en-us', '--locale', 'fr')
+            self.assertIn(self.path, output)
+            days = datetime_forms.DateOptionChoices.days()
+            tables = form_tables.load_tables(self.path)
+            self.assertEqual(sorted(name for name in tables.index
+                if name.startswith('fragments:fr:')),
+                ['fragments:fr:{0}'.format(name)
+                    for name in sorted(form_tables.CHOICE_TABLES)])
+            self.assertEqual(list(tables.choices('days')), days)
+
+        @unittest.skipIf(django.VERSION < (1, 7), 'no app registry')
+        def test_app_ready(self):
+            # MoreFormsConfig.ready maps the configured file
+            import importlib
+            from django.test.utils import override_settings
+
+            form_tables.write_tables(self.path,
+                form_tables.build_tables(['en-us']))
+            package_dir = os.path.dirname(os.path.abspath(__file__))
+            package_name = os.path.basename(package_dir)
+            sys.path.append(os.path.dirname(package_dir))
+            try:
+                package = importlib.import_module(package_name)
+                apps = importlib.import_module(package_name + '.apps')
+            finally:
+                sys.path.pop()
+            config = apps.MoreFormsConfig(package_name, package)
+            try:
+                with override_settings(MORE_FORMS_TABLES_PATH=self.path):
+                    config.ready()
+                self.assertEqual(list(apps.form_tables.get_choices('days')),
+                    datetime_forms.DateOptionChoices.days())
+            finally:
+                apps.form_tables.unload_tables()
+            with override_settings(MORE_FORMS_TABLES_PATH=None):
+                config.ready()
+            self.assertEqual(apps.form_tables.get_choices('days'), None)
+
+        def test_requires_output(self):
+            from django.core.management.base import CommandError
+            from django.test.utils import override_settings
+
+            with override_settings(MORE_FORMS_TABLES_PATH=None):
+                self.assertRaises(CommandError, self.run_command,
+                    '--traceback')
+
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import sys
+import subprocess
+
+# Import cost of the form modules, measured in a fresh interpreter after
+# django's own modules are loaded so only this package's share is counted.
+# Short lived processes (management commands, serverless handlers) pay it
+# on every start. Wall clock times depend on the machine and its load, so
+# the budgets are only checked on request; report exits non-zero when a
+# module is over budget. The tests only check the lazy imports. With
+# PYTHONDONTWRITEBYTECODE set, the times include compiling the source.
+#
+#     python import_budget.py report
+
+# milliseconds, cumulative for the module and what it imports
+IMPORT_BUDGETS = {
+    'form_tables': 5,
+    'time_forms': 10,
+    'datetime_forms': 15,}
+
+# imported on first use, never by importing the form modules; json is left
+# out, django.forms loads it itself from 1.7 on
+LAZY_MODULES = ('numpy', 'mmap',)
+
+PRELOADED = (
+    'django.forms',
+    'django.forms.formsets',
+    'django.utils.timezone',
+    'django.utils.safestring',)
+
+_SCRIPT = '''
+import sys, time
+{preload}
+before = set(sys.modules)
+started = time.time()
+import {module}
+sys.stdout.write('%f\\n' % ((time.time() - started) * 1000))
+sys.stdout.write(' '.join(name for name in {lazy!r}
+    if name in sys.modules and name not in before))
+'''
+
+def _environ():
+    environ = dict(os.environ)
+    environ['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+    return environ
+
+def measure_import(module, runs=3):
+    # (milliseconds, lazy modules loaded) for the best of runs, after one
+    # warm up run
+    script = _SCRIPT.format(module=module, lazy=LAZY_MODULES,
+        preload='\n'.join('import {0}'.format(name) for name in PRELOADED))
+    command = [sys.executable, '-c', script]
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    best = None
+    loaded = ()
+    for run in xrange(runs + 1):
+        process = subprocess.Popen(command, cwd=cwd, env=_environ(),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        out, err = process.communicate()
+        if process.returncode:
+            raise RuntimeError('import {0} failed:\n{1}'.format(module, err))
+        lines = out.splitlines()
+        milliseconds = float(lines[0])
+        loaded = tuple(lines[1].split()) if len(lines) > 1 else ()
+        if run and (best is None or milliseconds < best):
+            best = milliseconds
+    return best, loaded
+
+def report(stream=None):
+    stream = stream or sys.stdout
+    results = {}
+    stream.write('module           ms  budget  lazy loaded\n')
+    for module in sorted(IMPORT_BUDGETS):
+        milliseconds, loaded = measure_import(module)
+        results[module] = (milliseconds, loaded,)
+        stream.write('{0:14s} {1:5.1f}  {2:6d}  {3}\n'.format(module,
+            milliseconds, IMPORT_BUDGETS[module], ' '.join(loaded) or '-'))
+    return results
+
+if __name__ == '__main__':
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'tests',
+        'django_more_forms_tests',))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_more_forms_tests.settings'
+
+    if sys.argv[1:2] == ['report']:
+        results = report()
+        sys.exit(int(any(results[module][0] > budget or results[module][1]
+            for module, budget in IMPORT_BUDGETS.items())))
+
+    import unittest
+    from django.test import SimpleTestCase
+
+    class ImportBudgetTest(SimpleTestCase):
+
+        def test_lazy_modules(self):
+            for module in IMPORT_BUDGETS:
+                self.assertEqual(measure_import(module, runs=1)[1], ())
+
+        def test_lazy_modules_loaded_by_import(self):
+            # only what the import itself adds is reported
+            global LAZY_MODULES, PRELOADED
+            saved = LAZY_MODULES, PRELOADED
+            LAZY_MODULES = ('mmap', 'json',)
+            PRELOADED = saved[1] + ('json',)
+            try:
+                self.assertEqual(measure_import('mmap', runs=1)[1], ('mmap',))
+                self.assertEqual(measure_import('json', runs=1)[1], ())
+            finally:
+                LAZY_MODULES, PRELOADED = saved
+
+        def test_numpy_on_first_use(self):
+            import datetime_forms
+            saved = datetime_forms._numpy
+            datetime_forms._numpy = False
+            try:
+                numpy = datetime_forms.get_numpy()
+                self.assertTrue(numpy is None or numpy.__name__ == 'numpy')
+                self.assertTrue(datetime_forms.get_numpy() is numpy)
+            finally:
+                datetime_forms._numpy = saved
+
+    unittest.main()
@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import form_tables
+
+class Command(BaseCommand):
+
+    help = 'Precompute choice tables, option fragments and the 12 hour ' \
+        'table into a file that workers memory-map at startup.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+            help='Defaults to settings.MORE_FORMS_TABLES_PATH.'),
+        make_option('--locale', dest='locales', action='append',
+            default=[], help='Locale to render, may be repeated.'),)
+
+    def handle(self, *args, **options):
+        path = options['output'] or \
+            getattr(settings, 'MORE_FORMS_TABLES_PATH', None)
+        if not path:
+            raise CommandError('Pass --output or set MORE_FORMS_TABLES_PATH')
+
+        locales = options['locales'] or \
+            getattr(settings, 'MORE_FORMS_LOCALES', None) or \
+            [settings.LANGUAGE_CODE]
+
+        # build from the python choice classes, not a previous file
+        form_tables.unload_tables()
+        tables = form_tables.build_tables(locales)
+        form_tables.write_tables(path, tables)
+        self.stdout.write('Wrote {0} tables (version {1}) to {2}'.format(
+            len(tables), form_tables.VERSION, path))
@@ -0,0 +1,292 @@
+import re
+
+from django.forms import widgets as django_widgets
+from django.utils.encoding import force_text
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+import datetime_forms
+import form_tables
+
+# Batch rendering of one split select field across every form of a
+# formset. The field's widget is rendered once with placeholder names and
+# nothing selected; that html is cut into a row template (name and id
+# slots, and per select the options with the selected attribute spliced in
+# for each value) and every row is stamped from it instead of going through
+# the widgets. Rows come out identical to form[name].as_widget(): each new
+# template is checked against a real render first and widgets the template
+# can't reproduce are rendered the normal way.
+#
+#     {{ schedule_rows }} = render_column(formset, 'start')
+
+NAME_SLOT = u'\x00name\x00'
+NO_CHOICE = u'\x00'
+
+SELECTED = u' selected="selected"'
+
+_slots = re.compile(u'({0})'.format(NAME_SLOT))
+
+def leaf_widgets(widget):
+    # the selects a widget renders, in render order
+    if isinstance(widget, datetime_forms.SplitDateTimeSelectWidget):
+        return widget.date_widgets.widgets + widget.time_widgets.widgets
+    if isinstance(widget, django_widgets.MultiWidget):
+        leaves = []
+        for sub_widget in widget.widgets:
+            leaves.extend(leaf_widgets(sub_widget))
+        return leaves
+    return [widget]
+
+def leaf_values(widget, value):
+    # the value each select is rendered with, the way the widgets' own
+    # render methods hand them out
+    if isinstance(widget, datetime_forms.SplitDateTimeSelectWidget):
+        return leaf_values(widget.date_widgets, value) + \
+            leaf_values(widget.time_widgets, value)
+    if isinstance(widget, django_widgets.MultiWidget):
+        if not isinstance(value, list):
+            value = widget.decompress(value)
+        values = []
+        for i, sub_widget in enumerate(widget.widgets):
+            try:
+                sub_value = value[i]
+            except IndexError:
+                sub_value = None
+            values.extend(leaf_values(sub_widget, sub_value))
+        return values
+    return [value]
+
+def _is_plain_select(widget):
+    # Select or a subclass only setting attrs and choices; options rendered
+    # from the mapped tables are the same html
+    select = django_widgets.Select
+    if not isinstance(widget, select) or widget.allow_multiple_selected:
+        return False
+    for method in ('render', 'render_options', 'render_option',
+            'build_attrs',):
+        if getattr(widget.__class__, method) not in (getattr(select, method),
+                getattr(form_tables.TableOptionsMixin, method, None),):
+            return False
+    for option_value, option_label in widget.choices:
+        if isinstance(option_label, (list, tuple,)):
+            return False
+    return True
+
+def template_key(widget):
+    # everything besides name, id and value that changes the html, or
+    # None when the widget can't be stamped
+    if not isinstance(widget, django_widgets.MultiWidget) or \
+            widget.is_localized:
+        return None
+    leaves = leaf_widgets(widget)
+    if not all(_is_plain_select(leaf) for leaf in leaves):
+        return None
+    key = (widget.__class__, tuple(sorted(widget.attrs.items())),
+        tuple((tuple(sorted(leaf.attrs.items())), tuple(leaf.choices),)
+            for leaf in leaves),)
+    # used as the templates key as is, a bare hash could collide
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+class RowTemplate(object):
+
+    def __init__(self, widget, id_format):
+        # id_format is the id with the name replaced by NAME_SLOT, the
+        # widgets rewrite the name inside ids as well
+        self.size = len(leaf_widgets(widget))
+        attrs = {'id': id_format} if id_format else {}
+        html = force_text(widget.render(NAME_SLOT, [NO_CHOICE] * self.size,
+            attrs=attrs))
+        segments = html.split(u'</select>')
+        if len(segments) != self.size + 1:
+            raise ValueError('Unexpected markup for {0}'.format(
+                widget.__class__.__name__))
+        self.heads = []
+        self.bodies = []
+        for segment in segments[:-1]:
+            tag_end = segment.index(u'>', segment.index(u'<select')) + 1
+            self.heads.append(_slots.split(segment[:tag_end]))
+            self.bodies.append(segment[tag_end:])
+        self.tail = _slots.split(segments[-1])
+        # options with the selected attribute, per select and value
+        self.selected_bodies = [{} for body in self.bodies]
+
+    def selected_body(self, index, value):
+        if value is None:
+            value = u''
+        value = force_text(value)
+        bodies = self.selected_bodies[index]
+        try:
+            return bodies[value]
+        except KeyError:
+            pass
+        body = self.bodies[index]
+        needle = u'<option value="{0}">'.format(conditional_escape(value))
+        position = body.find(needle)
+        if position != -1:
+            position += len(needle) - 1
+            body = body[:position] + SELECTED + body[position:]
+        bodies[value] = body
+        return body
+
+    def stamp(self, parts, name, values):
+        slots = {NAME_SLOT: conditional_escape(name),}
+        for index, head in enumerate(self.heads):
+            for piece in head:
+                parts.append(slots.get(piece, piece))
+            parts.append(self.selected_body(index, values[index]))
+            parts.append(u'</select>')
+        for piece in self.tail:
+            parts.append(slots.get(piece, piece))
+        return parts
+
+def _stamp_parts(formset, name):
+    # one list of html parts per form
+    templates = {}
+    rows = []
+    for form in formset:
+        bound_field = form[name]
+        widget = bound_field.field.widget
+        key = template_key(widget)
+        if key is None or bound_field.field.localize:
+            rows.append([force_text(bound_field.as_widget())])
+            continue
+        html_name = bound_field.html_name
+        auto_id = bound_field.auto_id
+        id_format = None
+        if auto_id and 'id' not in widget.attrs:
+            id_format = auto_id.replace(html_name, NAME_SLOT)
+        values = leaf_values(widget, bound_field.value())
+        template = templates.get((key, id_format,), None)
+        if template is None:
+            try:
+                template = RowTemplate(widget, id_format)
+            except ValueError:
+                template = False
+            expected = force_text(bound_field.as_widget())
+            if template and (len(values) != template.size or u''.join(
+                    template.stamp([], html_name, values)) != expected):
+                template = False
+            templates[(key, id_format,)] = template
+            rows.append([expected])
+            continue
+        if not template or len(values) != template.size:
+            rows.append([force_text(bound_field.as_widget())])
+            continue
+        rows.append(template.stamp([], html_name, values))
+    return rows
+
+def render_rows(formset, name):
+    # form[name].as_widget() for every form of the formset
+    return [mark_safe(u''.join(parts)) for parts in
+        _stamp_parts(formset, name)]
+
+def render_column(formset, name, separator=u'\n'):
+    # the same rows with a single join
+    parts = []
+    for i, row in enumerate(_stamp_parts(formset, name)):
+        if i:
+            parts.append(separator)
+        parts.extend(row)
+    return mark_safe(u''.join(parts))
+
+if __name__ == '__main__':
+    import os, sys
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'tests',
+        'django_more_forms_tests',))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_more_forms_tests.settings'
+
+    import datetime
+    import unittest
+    import pytz
+    from django import forms as django_forms
+    from django.test import SimpleTestCase
+    from django.utils import timezone
+
+    import time_forms
+
+    class SlotForm(django_forms.Form):
+
+        start = datetime_forms.SplitDateTimeField()
+        day = datetime_forms.SplitDateField(required=False)
+        at = time_forms.SplitTimeField(required=False)
+        at_24 = time_forms.SplitTimeField(hours=24, step=15, required=False)
+        note = django_forms.CharField(required=False)
+
+    SlotFormSet = django_forms.formsets.formset_factory(SlotForm, extra=2)
+
+    FIELD_NAMES = ('start', 'day', 'at', 'at_24', 'note',)
+
+    def initial_rows(count):
+        rows = []
+        for i in xrange(count):
+            start = pytz.utc.localize(datetime.datetime(2013, 1 + i % 12,
+                1 + i % 28, i % 24, i * 7 % 60))
+            rows.append({'start': start, 'day': start.date(),
+                'at': datetime.time(i % 24, i * 5 % 60),
+                'at_24': datetime.time((i + 3) % 24, i * 15 % 60),})
+        return rows
+
+    class RenderRowsTest(SimpleTestCase):
+
+        def assertSameRows(self, formset):
+            for name in FIELD_NAMES:
+                expected = [form[name].as_widget() for form in formset]
+                self.assertEqual(render_rows(formset, name), expected)
+                self.assertEqual(render_column(formset, name),
+                    u'\n'.join(expected))
+
+        def test_unbound(self):
+            for tz in ('UTC', 'America/New_York', 'Asia/Tokyo',):
+                with timezone.override(pytz.timezone(tz)):
+                    self.assertSameRows(SlotFormSet(initial=initial_rows(60),
+                        prefix='slots'))
+
+        def test_bound(self):
+            data = {'slots-TOTAL_FORMS': '3', 'slots-INITIAL_FORMS': '0',
+                'slots-MAX_NUM_FORMS': '',
+                'slots-0-start_0': '3', 'slots-0-start_1': '1',
+                'slots-0-start_2': '2013', 'slots-0-start_3': '9',
+                'slots-0-start_4': '30', 'slots-0-start_5': 'am',
+                'slots-1-start_0': '13', 'slots-1-start_3': '<b>',
+                'slots-1-at_0': '12', 'slots-1-at_1': '55',
+                'slots-2-at_24_0': '23', 'slots-2-at_24_1': '45',}
+            formset = SlotFormSet(data, prefix='slots')
+            self.assertSameRows(formset)
+
+        def test_no_auto_id(self):
+            self.assertSameRows(SlotFormSet(initial=initial_rows(3),
+                auto_id=False))
+
+        def test_per_form_widgets(self):
+            formset = SlotFormSet(initial=initial_rows(4))
+            formset.forms[1].fields['at'].widget.widgets[0].attrs = {
+                'data-row': '1'}
+            formset.forms[2].fields['at'].widget.widgets[1].choices = [
+                (0, '00',), (30, '30',)]
+            self.assertSameRows(formset)
+
+        def test_template_key(self):
+            # compared by value, not by hash
+            form = SlotForm()
+            key = template_key(form.fields['at'].widget)
+            self.assertEqual(key, template_key(SlotForm().fields['at'].widget))
+            self.assertTrue(isinstance(key, tuple))
+            widget = form.fields['at'].widget.widgets[0]
+            widget.attrs = {'data-row': ['1']}
+            self.assertEqual(template_key(form.fields['at'].widget), None)
+
+        def test_stamped(self):
+            # rows after the first come from the template
+            formset = SlotFormSet(initial=initial_rows(3))
+            rows = _stamp_parts(formset, 'start')
+            self.assertEqual(len(rows[0]), 1)
+            self.assertTrue(len(rows[1]) > 1)
+            self.assertEqual(len(_stamp_parts(formset, 'note')[1]), 1)
+
+    unittest.main()
@@ -3,3 +3,25 @@ coverage run time_forms.py
 coverage report
 coverage run datetime_forms.py
 coverage report
+coverage run csv_import.py
+coverage report
+coverage run form_tables.py
+coverage report
+coverage run filter_forms.py
+coverage report
+coverage run availability_forms.py
+coverage report
+coverage run fingerprint.py
+coverage report
+coverage run compiled_clean.py
+coverage report
+coverage run bulk_post.py
+coverage report
+coverage run split_codec.py
+coverage report
+coverage run thread_bench.py
+coverage report
+coverage run row_stamp.py
+coverage report
+coverage run import_budget.py
+coverage report
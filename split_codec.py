@@ -0,0 +1,351 @@
+import re
+import datetime
+
+import pytz
+
+# Compact integer forms of split field values for sessions and wizard
+# storage. Raw sub-values (the strings posted by the selects) are packed
+# as bit fields, one table code per select, so a six part
+# SplitDateTimeField fits in a 36 bit int instead of a list of six
+# strings. Only values that unpack to exactly the same strings are packed;
+# anything else is stored as it was.
+
+PACKED_KEY = '__packed__'
+
+_number = re.compile(r'^[0-9]+\Z')
+
+class Part(object):
+
+    def __init__(self, tokens):
+        self.tokens = tuple(unicode(token) for token in tokens)
+        self.codes = dict((token, code,)
+            for code, token in enumerate(self.tokens))
+        self.bits = (len(self.tokens) - 1).bit_length()
+
+    def encode(self, value):
+        if value.__class__ not in (str, unicode,):
+            return None
+        return self.codes.get(value, None)
+
+    def decode(self, code):
+        return self.tokens[code]
+
+class NumberPart(object):
+
+    # blank or any non-negative integer in canonical form; only used as
+    # the last, most significant, part of a layout
+    bits = None
+
+    def encode(self, value):
+        if value.__class__ not in (str, unicode,):
+            return None
+        if value == '':
+            return 0
+        # ascii digits only, isdigit() also takes u'\xb2' which int() won't
+        if not _number.match(value) or unicode(int(value)) != value:
+            return None
+        return int(value) + 1
+
+    def decode(self, code):
+        if code == 0:
+            return u''
+        return unicode(code - 1)
+
+def _numbers(low, high):
+    return [''] + [unicode(x) for x in xrange(low, high + 1)]
+
+MONTHS = Part(_numbers(1, 12))
+DAYS = Part(_numbers(1, 31))
+YEARS = Part(_numbers(1, 4095))
+HOURS = Part(_numbers(1, 12))
+HOURS_24 = Part(_numbers(0, 23))
+MINUTES = Part(_numbers(0, 59))
+AMPM = Part(['', 'am', 'pm'])
+TIME_METRICS = Part(['', 'min', 'hour'])
+
+class Layout(object):
+
+    def __init__(self, layout_id, parts):
+        self.layout_id = layout_id
+        self.parts = tuple(parts)
+
+    def pack(self, values):
+        if len(values) != len(self.parts):
+            return None
+        packed = 0
+        shift = 0
+        for value, part in zip(values, self.parts):
+            code = part.encode(value)
+            if code is None:
+                return None
+            packed |= code << shift
+            if part.bits is not None:
+                shift += part.bits
+        return packed
+
+    def unpack(self, packed):
+        values = []
+        for part in self.parts:
+            if part.bits is None:
+                values.append(part.decode(packed))
+                break
+            values.append(part.decode(packed & ((1 << part.bits) - 1)))
+            packed >>= part.bits
+        return values
+
+LAYOUT_BITS = 3
+
+# split widget layouts, tried in order for a group of that size
+SPLIT_DATETIME = Layout(1, [MONTHS, DAYS, YEARS, HOURS, MINUTES, AMPM])
+SPLIT_DATE = Layout(2, [MONTHS, DAYS, YEARS])
+SPLIT_TIME = Layout(3, [HOURS, MINUTES, AMPM])
+SPLIT_TIME_24 = Layout(4, [HOURS_24, MINUTES])
+DURATION = Layout(5, [TIME_METRICS, NumberPart()])
+
+SPLIT_LAYOUTS = (SPLIT_DATETIME, SPLIT_DATE, SPLIT_TIME, SPLIT_TIME_24,)
+LAYOUTS = dict((layout.layout_id, layout,)
+    for layout in SPLIT_LAYOUTS + (DURATION,))
+
+DURATION_FIELDS = ('time_amount', 'time_metric',)
+
+_split_key = re.compile(r'^(.*)_(\d)$')
+
+def pack_values(values, layouts=SPLIT_LAYOUTS):
+    for layout in layouts:
+        packed = layout.pack(values)
+        if packed is not None:
+            return packed << LAYOUT_BITS | layout.layout_id
+    return None
+
+def unpack_values(packed):
+    layout = LAYOUTS[packed & ((1 << LAYOUT_BITS) - 1)]
+    return layout, layout.unpack(packed >> LAYOUT_BITS)
+
+def _single(values):
+    # wizard step data keeps every key as a list of posted values
+    if isinstance(values, list) and len(values) == 1:
+        return values[0]
+    return None
+
+def pack_step_data(data):
+    groups = {}
+    for key in data:
+        match = _split_key.match(key)
+        if match is not None:
+            base, index = match.groups()
+            groups.setdefault(base, {})[int(index)] = key
+
+    packed_values = {}
+    packed_keys = set()
+    for base, keys in groups.items():
+        if sorted(keys) != range(len(keys)):
+            continue
+        values = [_single(data[keys[i]]) for i in xrange(len(keys))]
+        packed = pack_values(values)
+        if packed is not None:
+            packed_values[base] = packed
+            packed_keys.update(keys.values())
+
+    for key in data:
+        if not key.endswith(DURATION_FIELDS[0]):
+            continue
+        base = key[:-len(DURATION_FIELDS[0])]
+        metric_key = base + DURATION_FIELDS[1]
+        if metric_key not in data or base in packed_values:
+            continue
+        packed = pack_values([_single(data[metric_key]),
+            _single(data[key])], (DURATION,))
+        if packed is not None:
+            packed_values[base] = packed
+            packed_keys.update((key, metric_key,))
+
+    if not packed_values:
+        return data
+    result = dict((key, value,) for key, value in data.items()
+        if key not in packed_keys)
+    result[PACKED_KEY] = packed_values
+    return result
+
+def unpack_step_data(data):
+    if PACKED_KEY not in data:
+        return data
+    result = dict((key, value,) for key, value in data.items()
+        if key != PACKED_KEY)
+    for base, packed in data[PACKED_KEY].items():
+        layout, values = unpack_values(packed)
+        if layout is DURATION:
+            result[base + DURATION_FIELDS[1]] = [values[0]]
+            result[base + DURATION_FIELDS[0]] = [values[1]]
+        else:
+            for i, value in enumerate(values):
+                result['{0}_{1}'.format(base, i)] = [value]
+    return result
+
+class CompactStorageMixin(object):
+
+    # mix into a form wizard storage class, see CompactSessionStorage
+
+    def get_step_data(self, step):
+        from django.utils.datastructures import MultiValueDict
+
+        values = self.data[self.step_data_key].get(step, None)
+        if values is not None:
+            values = MultiValueDict(unpack_step_data(values))
+        return values
+
+    def set_step_data(self, step, cleaned_data):
+        from django.utils.datastructures import MultiValueDict
+
+        if isinstance(cleaned_data, MultiValueDict):
+            cleaned_data = dict(cleaned_data.lists())
+        self.data[self.step_data_key][step] = pack_step_data(cleaned_data)
+
+# formtools moved out of django.contrib in 1.8
+try:
+    from django.contrib.formtools.wizard.storage.session import \
+        SessionStorage
+except ImportError:
+    try:
+        from formtools.wizard.storage.session import SessionStorage
+    except ImportError:
+        SessionStorage = None
+
+if SessionStorage is not None:
+    class CompactSessionStorage(CompactStorageMixin, SessionStorage):
+        pass
+else:
+    CompactSessionStorage = None
+
+# cleaned values for form initial data, to the minute like the widgets
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+def pack_datetime(value):
+    # minutes since the epoch, i.e. day offset * 1440 + minute of the day
+    return int((value - EPOCH).total_seconds() // 60)
+
+def unpack_datetime(packed):
+    return EPOCH + datetime.timedelta(minutes=packed)
+
+def pack_time(value):
+    return value.hour * 60 + value.minute
+
+def unpack_time(packed):
+    return datetime.time(*divmod(packed, 60))
+
+def pack_initial(initial):
+    # aware datetimes and times become [kind, int] under PACKED_KEY
+    packed_values = {}
+    result = {}
+    for name, value in initial.items():
+        if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+            packed_values[name] = ['dt', pack_datetime(value)]
+        elif isinstance(value, datetime.time) and value.tzinfo is None:
+            packed_values[name] = ['t', pack_time(value)]
+        else:
+            result[name] = value
+    if packed_values:
+        result[PACKED_KEY] = packed_values
+    return result
+
+def unpack_initial(initial):
+    if PACKED_KEY not in initial:
+        return initial
+    unpack = {'dt': unpack_datetime, 't': unpack_time,}
+    result = dict((name, value,) for name, value in initial.items()
+        if name != PACKED_KEY)
+    for name, (kind, packed) in initial[PACKED_KEY].items():
+        result[name] = unpack[kind](packed)
+    return result
+
+if __name__ == '__main__':
+    import os, sys
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'tests',
+        'django_more_forms_tests',))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_more_forms_tests.settings'
+
+    import json
+    import unittest
+    from django.test import SimpleTestCase
+    from django.utils.datastructures import MultiValueDict
+
+    class LayoutTest(SimpleTestCase):
+
+        def test_roundtrip(self):
+            for values in (
+                    [u'3', u'1', u'2013', u'9', u'30', u'am'],
+                    [u'12', u'31', u'2013', u'12', u'55', u'pm'],
+                    [u'', u'', u'', u'', u'', u''],
+                    [u'2', u'30', u'2013', u'', u'5', u'pm'],):
+                packed = pack_values(values)
+                self.assertTrue(packed < 1 << 36)
+                self.assertEqual(unpack_values(packed),
+                    (SPLIT_DATETIME, values,))
+
+        def test_time_layouts(self):
+            self.assertEqual(unpack_values(pack_values([u'1', u'5', u'am'])),
+                (SPLIT_TIME, [u'1', u'5', u'am'],))
+            self.assertEqual(unpack_values(pack_values([u'23', u'45'])),
+                (SPLIT_TIME_24, [u'23', u'45'],))
+
+        def test_not_packable(self):
+            self.assertEqual(pack_values([u'03', u'1', u'2013']), None)
+            self.assertEqual(pack_values([u'13', u'1', u'2013']), None)
+            self.assertEqual(pack_values([u'3', None, u'2013']), None)
+            self.assertEqual(pack_values([u'3', u'1', u'2013', u'9']), None)
+            for amount in (u'\xb2', u'\u0661', u'1\n', u'-1', u'01'):
+                self.assertEqual(pack_values([u'hour', amount], (DURATION,)),
+                    None)
+            data = {u'x-time_amount': [u'\xb2'], u'x-time_metric': [u'hour']}
+            self.assertEqual(unpack_step_data(pack_step_data(data)), data)
+
+        def test_duration(self):
+            packed = pack_values([u'hour', u'125'], (DURATION,))
+            self.assertEqual(unpack_values(packed),
+                (DURATION, [u'hour', u'125'],))
+
+    class StepDataTest(SimpleTestCase):
+
+        def setUp(self):
+            self.data = {
+                u'0-start_0': [u'3'], u'0-start_1': [u'1'],
+                u'0-start_2': [u'2013'], u'0-start_3': [u'9'],
+                u'0-start_4': [u'30'], u'0-start_5': [u'am'],
+                u'0-time_amount': [u'2'], u'0-time_metric': [u'hour'],
+                u'0-at_0': [u'01'], u'0-at_1': [u'5'], u'0-at_2': [u'am'],
+                u'wizard_step': [u'0'],}
+
+        def test_roundtrip(self):
+            packed = pack_step_data(self.data)
+            self.assertEqual(sorted(packed[PACKED_KEY]), [u'0-', u'0-start'])
+            self.assertIn(u'0-at_0', packed)
+            self.assertTrue(len(json.dumps(packed)) <
+                len(json.dumps(self.data)))
+            self.assertEqual(unpack_step_data(json.loads(json.dumps(packed))),
+                self.data)
+
+        def test_storage(self):
+            class Storage(CompactStorageMixin):
+                step_data_key = 'step_data'
+                def __init__(self):
+                    self.data = {self.step_data_key: {}}
+            storage = Storage()
+            storage.set_step_data('0', MultiValueDict(self.data))
+            self.assertIn(PACKED_KEY, storage.data['step_data']['0'])
+            self.assertEqual(dict(storage.get_step_data('0').lists()),
+                self.data)
+
+    class InitialTest(SimpleTestCase):
+
+        def test_roundtrip(self):
+            initial = {
+                'start': pytz.utc.localize(datetime.datetime(2013, 3, 1, 14,
+                    35)),
+                'at': datetime.time(9, 5),
+                'time_amount': 2,}
+            packed = json.loads(json.dumps(pack_initial(initial)))
+            self.assertEqual(unpack_initial(packed), initial)
+
+    unittest.main()
@@ -0,0 +1,174 @@
+import time
+import datetime
+
+import pytz
+from django.utils import timezone
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+import time_forms
+import datetime_forms
+
+# Threaded stress benchmark: renders and cleans the split fields from many
+# threads at once (as under gunicorn gthread workers), checks every result
+# against the value that thread used to detect state leaking between
+# threads, and reports throughput from 1 to N threads.
+#
+#     python thread_bench.py bench [max_threads] [iterations]
+
+TIME_ZONES = ('America/New_York', 'Europe/Paris', 'Asia/Tokyo', 'UTC',)
+
+_form_class = None
+
+def get_form_class():
+    # built on first use, the split fields need configured settings
+    global _form_class
+    if _form_class is None:
+        class BenchForm(datetime_forms.DurationForm):
+
+            start = datetime_forms.SplitDateTimeField()
+            at = time_forms.SplitTimeField()
+            at_24 = time_forms.SplitTimeField(hours=24, step=15)
+        _form_class = BenchForm
+    return _form_class
+
+def _selected(value):
+    return '<option value="{0}" selected="selected">'.format(value)
+
+def render_and_clean(i):
+    # one unit of work; returns a list of problems, empty when consistent
+    problems = []
+    tz = pytz.timezone(TIME_ZONES[i % len(TIME_ZONES)])
+    local = datetime.datetime(2013, 1 + i % 12, 1 + i % 28, i % 24,
+        i * 5 % 60)
+    at = datetime.time((i + 7) % 24, i * 5 % 60)
+    at_24 = datetime.time((i + 3) % 24, i * 15 % 60)
+
+    BenchForm = get_form_class()
+    timezone.activate(tz)
+    try:
+        form = BenchForm(initial={'start': tz.localize(local), 'at': at,
+            'at_24': at_24})
+        # per instance attrs must never reach other widgets
+        form.fields['at'].widget.widgets[0].attrs['data-row'] = str(i)
+        html = form['start'].as_widget() + form['at'].as_widget() + \
+            form['at_24'].as_widget()
+        for expected in (
+                _selected(local.month), _selected(local.year),
+                _selected(time_forms.to_12_hr(local.hour)),
+                _selected(time_forms.to_12_hr(at.hour)),
+                _selected(at_24.hour),
+                'data-row="{0}"'.format(i),):
+            if expected not in html:
+                problems.append('render {0}: missing {1}'.format(i, expected))
+        if html.count('data-row=') != 1:
+            problems.append('render {0}: leaked attrs'.format(i))
+
+        form = BenchForm({
+            'start_0': str(local.month), 'start_1': str(local.day),
+            'start_2': str(local.year),
+            'start_3': str(time_forms.to_12_hr(local.hour)),
+            'start_4': str(local.minute),
+            'start_5': time_forms.get_ampm(local.hour).lower(),
+            'at_0': str(time_forms.to_12_hr(at.hour)),
+            'at_1': str(at.minute),
+            'at_2': time_forms.get_ampm(at.hour).lower(),
+            'at_24_0': str(at_24.hour), 'at_24_1': str(at_24.minute),
+            'time_amount': str(1 + i % 90), 'time_metric': 'min',})
+        if not form.is_valid():
+            problems.append('clean {0}: {1}'.format(i, form.errors))
+        else:
+            cleaned_data = form.cleaned_data
+            start = cleaned_data['start']
+            if start.replace(tzinfo=None) != local or \
+                    start.utcoffset() != tz.localize(local).utcoffset():
+                problems.append('clean {0}: start {1}'.format(i, start))
+            if cleaned_data['at'] != at or cleaned_data['at_24'] != at_24:
+                problems.append('clean {0}: times'.format(i))
+            if cleaned_data['time_delta'] != \
+                    datetime.timedelta(minutes=1 + i % 90):
+                problems.append('clean {0}: duration'.format(i))
+    finally:
+        timezone.deactivate()
+    return problems
+
+def _map(threads, func, items):
+    if ThreadPoolExecutor is not None:
+        executor = ThreadPoolExecutor(max_workers=threads)
+        try:
+            return list(executor.map(func, items))
+        finally:
+            executor.shutdown()
+    # python 2 without the futures backport
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def run(max_threads=8, iterations=2000):
+    results = []
+    threads = 1
+    while threads <= max_threads:
+        started = time.time()
+        outcomes = _map(threads, render_and_clean, xrange(iterations))
+        elapsed = time.time() - started
+        problems = [problem for outcome in outcomes for problem in outcome]
+        results.append({
+            'threads': threads,
+            'seconds': elapsed,
+            'per_second': iterations / elapsed if elapsed else 0.0,
+            'problems': problems,})
+        threads *= 2
+    return results
+
+def report(max_threads=8, iterations=2000, stream=None):
+    import sys
+    stream = stream or sys.stdout
+    results = run(max_threads, iterations)
+    base = results[0]['per_second'] or 1.0
+    stream.write('threads  forms/s  scaling  problems\n')
+    for result in results:
+        stream.write('{0:7d}  {1:7.0f}  {2:6.2f}x  {3:8d}\n'.format(
+            result['threads'], result['per_second'],
+            result['per_second'] / base, len(result['problems'])))
+    return results
+
+if __name__ == '__main__':
+    import os, sys
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'tests',
+        'django_more_forms_tests',))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_more_forms_tests.settings'
+
+    if sys.argv[1:2] == ['bench']:
+        report(*[int(arg) for arg in sys.argv[2:4]])
+        sys.exit(0)
+
+    import unittest
+    from django.test import SimpleTestCase
+
+    class ThreadBenchTest(SimpleTestCase):
+
+        def test_single_thread(self):
+            for i in xrange(48):
+                self.assertEqual(render_and_clean(i), [])
+
+        def test_threads_do_not_leak_state(self):
+            for result in run(max_threads=4, iterations=200):
+                self.assertEqual(result['problems'], [],
+                    result['problems'][:5])
+
+        def test_shared_tables(self):
+            # built once, then read without locks from every thread
+            modes = _map(8, lambda i: time_forms.TimeMode.get(24, 15),
+                xrange(64))
+            self.assertTrue(all(mode is modes[0] for mode in modes))
+
+    unittest.main()
@@ -1,3 +1,4 @@
+import re
 import datetime
 import math
 import time
@@ -6,6 +7,8 @@ from django.utils import timezone
 from django.forms import widgets as django_widgets
 from django import forms as django_forms
 
+import form_tables
+
 TIME_FORMAT = "%I:%M %p"
 
 def to_24_hr(hour, am_pm):
@@ -66,12 +69,18 @@ class TimeOptionChoices(object):
 
     @classmethod
     def hours(cls):
+        hours = form_tables.get_choices('hours')
+        if hours is not None:
+            return hours
         hours = [(x, x,) for x in xrange(1,13)]
         hours.insert(0, cls.BLANK_CHOICE)
         return hours
 
     @classmethod
     def minutes(cls):
+        minutes = form_tables.get_choices('minutes')
+        if minutes is not None:
+            return minutes
         minutes = [(x,'0' + str(x)) for x in xrange(0, 10, 5)]
         minutes.extend([(x, x,) for x in xrange(10, 60, 5)])
         minutes.insert(0, cls.BLANK_CHOICE)
@@ -79,34 +88,185 @@ class TimeOptionChoices(object):
 
     @classmethod
     def ampm(cls):
+        ampm = form_tables.get_choices('ampm')
+        if ampm is not None:
+            return ampm
         ampm = (cls.BLANK_CHOICE, ('am', 'AM',), ('pm', 'PM',),)
         return ampm
 
-class HourSelectWidget(django_widgets.Select):
+class HourSelectWidget(form_tables.TableOptionsMixin, django_widgets.Select):
+
+    table_name = 'hours'
 
     def __init__(self, attrs={'class': 'hours-select'}):
         super(HourSelectWidget, self).__init__(attrs)
         self.choices = TimeOptionChoices.hours()
 
-class MinuteSelectWidget(django_widgets.Select):
+class MinuteSelectWidget(form_tables.TableOptionsMixin, django_widgets.Select):
+
+    table_name = 'minutes'
 
     def __init__(self, attrs={'class': 'minutes-select'}):
         super(MinuteSelectWidget, self).__init__(attrs)
         self.choices = TimeOptionChoices.minutes()
 
-class AmPmSelectWidget(django_widgets.Select):
+class AmPmSelectWidget(form_tables.TableOptionsMixin, django_widgets.Select):
+
+    table_name = 'ampm'
 
     def __init__(self, attrs={'class': 'ampm-select'}):
         super(AmPmSelectWidget, self).__init__(attrs)
         self.choices = TimeOptionChoices.ampm()
 
+class TimeMode(object):
+
+    # Choices and conversion tables for one hour format and minute step,
+    # built once and shared by every widget and field using it. The
+    # decompress table is indexed by minute of the day, the compress table
+    # by the cleaned select values.
+
+    HOURS = (12, 24,)
+    STEPS = (1, 5, 15, 30,)
+
+    _modes = {}
+
+    @classmethod
+    def get(cls, hours=12, step=5):
+        try:
+            return cls._modes[(hours, step,)]
+        except KeyError:
+            return cls._modes.setdefault((hours, step,), cls(hours, step))
+
+    def __init__(self, hours=12, step=5):
+        if hours not in self.HOURS:
+            raise ValueError('hours must be one of {0}'.format(self.HOURS))
+        if step not in self.STEPS:
+            raise ValueError('step must be one of {0}'.format(self.STEPS))
+        self.hours = hours
+        self.step = step
+        minutes = range(0, 60, step)
+
+        if step == 5:
+            self.minute_choices = tuple(TimeOptionChoices.minutes())
+        else:
+            self.minute_choices = (TimeOptionChoices.BLANK_CHOICE,) + \
+                tuple((x, '%02d' % x,) for x in minutes)
+        if hours == 12:
+            self.hour_choices = tuple(TimeOptionChoices.hours())
+            self.ampm_choices = tuple(TimeOptionChoices.ampm())
+        else:
+            self.hour_choices = (TimeOptionChoices.BLANK_CHOICE,) + \
+                tuple((x, '%02d' % x,) for x in xrange(24))
+            self.ampm_choices = None
+
+        # (12 hour, ampm) per hour of the day
+        hours_12 = form_tables.get_table('hours:24') or \
+            [(to_12_hr(hour), get_ampm(hour).lower(),) for hour in xrange(24)]
+
+        decompress_table = []
+        for minute_of_day in xrange(24 * 60):
+            hour, minute = divmod(minute_of_day, 60)
+            minute = minute // step * step
+            if hours == 12:
+                decompress_table.append((hours_12[hour][0], minute,
+                    hours_12[hour][1],))
+            else:
+                decompress_table.append((hour, minute,))
+        self.decompress_table = tuple(decompress_table)
+
+        self.compress_table = {}
+        for hour in xrange(24):
+            for minute in minutes:
+                if hours == 12:
+                    key = (unicode(hours_12[hour][0]), unicode(minute),
+                        unicode(hours_12[hour][1]),)
+                else:
+                    key = (unicode(hour), unicode(minute),)
+                self.compress_table[key] = datetime.time(hour, minute)
+
+    @property
+    def size(self):
+        return 3 if self.hours == 12 else 2
+
+    def decompress(self, value):
+        return self.decompress_table[value.hour * 60 + value.minute]
+
+    def compress(self, data_list):
+        try:
+            return self.compress_table[tuple(data_list)]
+        except (KeyError, TypeError):
+            return None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def minute_bucket(value, minutes):
+    # utc minute since the epoch, floored to a multiple of minutes; naive
+    # datetimes are taken as utc
+    offset = value.utcoffset()
+    if offset is not None:
+        value = value.replace(tzinfo=None) - offset
+    delta = value - EPOCH
+    minute = delta.days * 1440 + delta.seconds // 60
+    return minute - minute % minutes
+
+def offset_fits(value, minutes):
+    # whether every datetime of a utc bucket of that many minutes shares
+    # the local selects of value, i.e. its offset is a whole number of
+    # buckets
+    offset = value.utcoffset()
+    return offset is None or \
+        (offset.days * 86400 + offset.seconds) % (minutes * 60) == 0
+
+class DecompressMemo(object):
+
+    # Bounded memo of widget decompress results for aware datetimes, keyed
+    # by the widget on the active time zone and the utc minute bucket.
+    # Results are tuples shared by every caller. Emptied when full; the
+    # counters may miss a few lookups under threads.
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def get(self, key):
+        result = self.results.get(key, None)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def set(self, key, result):
+        if len(self.results) >= self.max_size:
+            self.results = {}
+        self.results[key] = result
+
+    def clear(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
 class SplitTimeSelectWidget(django_widgets.MultiWidget):
 
-    def __init__(self, attrs=None):
+    memo = DecompressMemo()
+
+    def __init__(self, attrs=None, hours=12, step=5):
+        self.mode = TimeMode.get(hours, step)
         widgets = []
         widgets.append(HourSelectWidget())
         widgets.append(MinuteSelectWidget())
-        widgets.append(AmPmSelectWidget())
+        if self.mode.hours == 12:
+            widgets.append(AmPmSelectWidget())
+        if (hours, step,) != (12, 5,):
+            widgets[0].choices = self.mode.hour_choices
+            widgets[1].choices = self.mode.minute_choices
         widgets = tuple(widgets)
 
         super(SplitTimeSelectWidget, self).__init__(widgets, attrs)
@@ -115,16 +275,25 @@ class SplitTimeSelectWidget(django_widgets.MultiWidget):
         # value arg in should be field's cleaned value
 
         if not value:
-            return [None, None, None]
+            return (None,) * self.mode.size
 
         if value:
+            if isinstance(value, datetime.datetime) and \
+                    timezone.is_aware(value):
+                mode = self.mode
+                key = (mode.hours, mode.step,
+                    timezone.get_current_timezone(),
+                    minute_bucket(value, mode.step),)
+                result = self.memo.get(key)
+                if result is None:
+                    value = timezone.localtime(value)
+                    result = mode.decompress(value)
+                    if offset_fits(value, mode.step):
+                        self.memo.set(key, result)
+                return result
             if timezone.is_aware(value):
                 value = timezone.localtime(value)
-            hour = to_12_hr(value.hour)
-            min = round_to_five_minutes(value.minute)
-            am_or_pm = get_ampm(value.hour).lower()
-
-            return [hour, min, am_or_pm,]
+            return self.mode.decompress(value)
 
 class SplitTimeField(django_forms.MultiValueField):
 
@@ -132,12 +301,27 @@ class SplitTimeField(django_forms.MultiValueField):
     widget = SplitTimeSelectWidget
 
     def __init__(self, *args, **kwargs):
+        hours = kwargs.pop('hours', 12)
+        step = kwargs.pop('step', 5)
+        self.mode = TimeMode.get(hours, step)
 
         fields = []
-        for field_name in self.FIELD_NAMES:
-            choice = getattr(TimeOptionChoices, field_name)
-            choice_field = django_forms.ChoiceField(choices=choice())
-            fields.append(choice_field)
+        if (hours, step,) == (12, 5,):
+            for field_name in self.FIELD_NAMES:
+                choice = getattr(TimeOptionChoices, field_name)
+                choice_field = django_forms.ChoiceField(choices=choice())
+                fields.append(choice_field)
+        else:
+            fields.append(django_forms.ChoiceField(
+                choices=self.mode.hour_choices))
+            fields.append(django_forms.ChoiceField(
+                choices=self.mode.minute_choices))
+            if self.mode.hours == 12:
+                fields.append(django_forms.ChoiceField(
+                    choices=self.mode.ampm_choices))
+            if 'widget' not in kwargs:
+                kwargs['widget'] = SplitTimeSelectWidget(hours=hours,
+                    step=step)
         fields = tuple(fields)
 
         super(SplitTimeField, self).__init__(
@@ -149,6 +333,15 @@ class SplitTimeField(django_forms.MultiValueField):
             return None
 
         if data_list:
+            value = self.mode.compress(data_list)
+            if value is not None:
+                return value
+
+            # values outside the table, let strptime report them
+            if self.mode.hours == 24:
+                s = time.strptime('{0}:{1}'.format(*data_list), '%H:%M')
+                return datetime.datetime(*s[:6]).time()
+
             hour = data_list[0]
             min = data_list[1]
             am_or_pm = data_list[2]
@@ -160,6 +353,71 @@ class SplitTimeField(django_forms.MultiValueField):
             s = datetime.datetime(*s[:6]).time()
             return s
 
+# native html5 inputs
+
+# HH:MM or HH:MM:SS as sent by <input type="time">, checked before parsing
+# so every python accepts the same strings; fromisoformat takes more forms
+# on newer versions
+ISO_TIME = re.compile(r'^[0-9]{2}:[0-9]{2}(:[0-9]{2})?\Z')
+
+def _parse_iso_time(value):
+    second = int(value[6:8]) if len(value) == 8 else 0
+    return datetime.time(int(value[0:2]), int(value[3:5]), second)
+
+# the C implemented parser when the running python has one
+_time_from_iso = getattr(datetime.time, 'fromisoformat', _parse_iso_time)
+
+def parse_iso_time(value):
+    if not ISO_TIME.match(value):
+        raise ValueError('Invalid isoformat string: {0!r}'.format(value))
+    return _time_from_iso(value)
+
+class NativeTimeInput(django_widgets.TextInput):
+
+    input_type = 'time'
+
+    def __init__(self, attrs={'class': 'time-input'}, step=5):
+        super(NativeTimeInput, self).__init__(attrs)
+        self.step = step
+        self.attrs['step'] = step * 60
+
+    def _format_value(self, value):
+        if isinstance(value, (datetime.datetime, datetime.time,)):
+            if timezone.is_aware(value):
+                value = timezone.localtime(value)
+            return '%02d:%02d' % (value.hour,
+                value.minute // self.step * self.step)
+        return value
+
+class NativeTimeField(django_forms.Field):
+
+    # single <input type="time"> alternative to SplitTimeField, cleaning to
+    # the same naive datetime.time on the same minute step
+
+    widget = NativeTimeInput
+    default_error_messages = {
+        'invalid': 'Enter a valid time.',}
+
+    def __init__(self, *args, **kwargs):
+        self.step = kwargs.pop('step', 5)
+        if 'widget' not in kwargs:
+            kwargs['widget'] = NativeTimeInput(step=self.step)
+        super(NativeTimeField, self).__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        if value in django_forms.fields.EMPTY_VALUES:
+            return None
+        if isinstance(value, datetime.time):
+            return value
+        try:
+            value = parse_iso_time(value.strip())
+        except (ValueError, TypeError, AttributeError):
+            raise django_forms.ValidationError(self.error_messages['invalid'])
+        if value.second or value.microsecond or value.tzinfo is not None or \
+                value.minute % self.step:
+            raise django_forms.ValidationError(self.error_messages['invalid'])
+        return value
+
 if __name__ == '__main__':
     import os, sys
     sys.path.append(os.path.join(
@@ -365,4 +623,161 @@ if __name__ == '__main__':
         def test_to_12_invalid_time_range(self):
             self.assertEqual(to_12_hr(25), None)
 
+    class TimeModeTest(SimpleTestCase):
+
+        def test_shared(self):
+            self.assertTrue(TimeMode.get(24, 15) is TimeMode.get(24, 15))
+            self.assertTrue(SplitTimeField().mode is
+                SplitTimeSelectWidget().mode)
+
+        def test_invalid(self):
+            self.assertRaises(ValueError, TimeMode.get, 12, 10)
+            self.assertRaises(ValueError, TimeMode.get, 36, 5)
+
+        def test_tables_match_helpers(self):
+            mode = TimeMode.get(12, 5)
+            for hour in xrange(24):
+                for minute in xrange(60):
+                    value = datetime.time(hour, minute)
+                    self.assertEqual(mode.decompress(value), (to_12_hr(hour),
+                        round_to_five_minutes(minute),
+                        get_ampm(hour).lower(),))
+
+        def test_24_hour_widget(self):
+            w = SplitTimeSelectWidget(hours=24, step=15)
+            rendered = w.render('time-select', datetime.time(21, 40))
+            self.assertEqual(len(w.widgets), 2)
+            self.assertNotIn('ampm-select', rendered)
+            self.assertIn('<option value="21" selected="selected">21',
+                rendered)
+            self.assertIn('<option value="30" selected="selected">30',
+                rendered)
+
+        def test_24_hour_field(self):
+            field = SplitTimeField(hours=24, step=15)
+            self.assertEqual(field.clean(['21', '45']), datetime.time(21, 45))
+            self.assertEqual(field.clean(['0', '0']), datetime.time(0, 0))
+            self.assertRaises(django_forms.ValidationError, field.clean,
+                ['21', '40'])
+            self.assertEqual(len(field.widget.widgets), 2)
+
+        def test_12_hour_one_minute_field(self):
+            field = SplitTimeField(step=1)
+            self.assertEqual(field.clean(['12', '7', 'am']),
+                datetime.time(0, 7))
+            self.assertEqual(field.widget.decompress(datetime.time(13, 59)),
+                (1, 59, 'pm',))
+
+    class DecompressMemoTest(SimpleTestCase):
+
+        def setUp(self):
+            import pytz
+            self.pytz = pytz
+            SplitTimeSelectWidget.memo.clear()
+
+        def uncached(self, mode, value):
+            return mode.decompress(timezone.localtime(value))
+
+        def test_matches_uncached(self):
+            start = self.pytz.utc.localize(datetime.datetime(2013, 3, 9, 20))
+            for name, step in (('America/New_York', 5,),
+                    ('Asia/Kathmandu', 5,), ('Asia/Kathmandu', 30,),
+                    ('UTC', 1,),):
+                widget = SplitTimeSelectWidget(step=step)
+                with timezone.override(self.pytz.timezone(name)):
+                    # spans the new york dst change
+                    for minute in xrange(0, 2 * 24 * 60, 3):
+                        value = start + datetime.timedelta(minutes=minute,
+                            seconds=minute % 60)
+                        self.assertEqual(widget.decompress(value),
+                            self.uncached(widget.mode, value), (name, value))
+
+        def test_shared_results(self):
+            widget = SplitTimeSelectWidget()
+            value = self.pytz.utc.localize(datetime.datetime(2013, 3, 1, 14,
+                1))
+            first = widget.decompress(value)
+            self.assertTrue(isinstance(first, tuple))
+            self.assertTrue(SplitTimeSelectWidget().decompress(
+                value + datetime.timedelta(minutes=3)) is first)
+            memo = SplitTimeSelectWidget.memo
+            self.assertEqual((memo.hits, memo.misses,), (1, 1,))
+            # another zone is another key
+            with timezone.override(self.pytz.timezone('Asia/Tokyo')):
+                self.assertNotEqual(widget.decompress(value), first)
+            self.assertEqual(memo.misses, 2)
+
+        def test_offsets_off_the_bucket(self):
+            # kathmandu is +05:45, not whole 30 minute buckets
+            widget = SplitTimeSelectWidget(step=30)
+            value = self.pytz.utc.localize(datetime.datetime(2013, 3, 1, 14))
+            with timezone.override(self.pytz.timezone('Asia/Kathmandu')):
+                widget.decompress(value)
+            self.assertEqual(SplitTimeSelectWidget.memo.results, {})
+
+        def test_bounded(self):
+            memo = DecompressMemo(max_size=10)
+            for i in xrange(25):
+                memo.set(i, (i,))
+            self.assertTrue(len(memo.results) <= 10)
+            self.assertEqual(memo.get(24), (24,))
+
+        def test_naive_values_skip_memo(self):
+            widget = SplitTimeSelectWidget()
+            self.assertEqual(widget.decompress(datetime.time(13, 7)),
+                (1, 5, 'pm',))
+            self.assertEqual(widget.decompress(None), (None, None, None,))
+            self.assertEqual(SplitTimeSelectWidget.memo.misses, 0)
+
+    class NativeTimeFieldTest(SimpleTestCase):
+
+        def test_clean(self):
+            field = NativeTimeField()
+            self.assertEqual(field.clean('13:05'), datetime.time(13, 5))
+            self.assertEqual(field.clean('00:00:00'), datetime.time(0, 0))
+            self.assertEqual(field.clean(datetime.time(9, 30)),
+                datetime.time(9, 30))
+
+        def test_clean_matches_split_field(self):
+            native = NativeTimeField()
+            split = SplitTimeField()
+            for hour in xrange(24):
+                for minute in xrange(0, 60, 5):
+                    value = datetime.time(hour, minute)
+                    self.assertEqual(native.clean(value.strftime('%H:%M')),
+                        split.clean(SplitTimeSelectWidget().decompress(
+                            value) if value else ['12', '0', 'am']))
+
+        def test_clean_invalid(self):
+            field = NativeTimeField()
+            for value in ('13:07', '25:00', '1:05 pm', '13-05', ''):
+                self.assertRaises(django_forms.ValidationError, field.clean,
+                    value)
+            self.assertEqual(NativeTimeField(step=1).clean('13:07'),
+                datetime.time(13, 7))
+
+        def test_layout_before_parser(self):
+            # forms newer fromisoformat versions take are rejected first
+            global _time_from_iso
+            saved = _time_from_iso
+            for parser in (saved, lambda value: datetime.time(0, 0),):
+                _time_from_iso = parser
+                try:
+                    for value in ('1305', '13:05:00.000', '13:05Z',
+                            '13:05+01:00', 'T13:05', u'\u0661\u0663:05',
+                            '13:05\n'):
+                        self.assertRaises(ValueError, parse_iso_time, value)
+                    self.assertRaises(django_forms.ValidationError,
+                        NativeTimeField().clean, '1305')
+                finally:
+                    _time_from_iso = saved
+            self.assertEqual(parse_iso_time('13:05:30'),
+                datetime.time(13, 5, 30))
+
+        def test_render(self):
+            rendered = NativeTimeInput().render('at', datetime.time(21, 43))
+            self.assertIn('type="time"', rendered)
+            self.assertIn('value="21:40"', rendered)
+            self.assertIn('step="300"', rendered)
+
     unittest.main()